@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+An end-to-end benchmark of the renamer tool. Wikipedia season pages are 
+served from a local HTTP stand-in: the recorded single-season and 
+multi-season pages in the fixtures directory, which include double episodes 
+and names that need sanitising, and a synthetic page with thousands of 
+episode rows. For each page, a directory of dummy video and subtitle files is 
+generated, and fetching the show information, scraping the episodes, 
+planning the renames and performing them are timed separately.
+
+The scraped episodes and the planned renames are also checked, so that the 
+benchmark catches scraping regressions: it exits with an error if a page 
+doesn't yield the expected number of episodes or a file isn't renamed.
+"""
+
+import argparse
+import http.server
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+"""The directory containing the benchmarks."""
+
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+"""The directory containing the recorded pages."""
+
+sys.path.insert(0, os.path.join(BENCH_DIR, os.pardir, "source"))
+
+import bs4
+import renamer
+import vidsub
+
+
+PAGES = {"multi_season": {"file": "multi_season.html", "sngl": False, 
+                          "episodes": 9}, 
+         "single_season": {"file": "single_season.html", "sngl": True, 
+                           "episodes": 5}}
+"""The recorded pages, whether they're of single-season shows, and the 
+number of episodes expected to be scraped from them."""
+
+SYNTH_SHOW = "Synthetic Show"
+"""The name of the show of the synthetic page."""
+
+SYNTH_SEASON = 3
+"""The season number of the synthetic page."""
+
+DOUBLE_EVERY = 50
+"""How often a double episode occurs on the synthetic page."""
+
+SYNTH_HEAD = """<!DOCTYPE html>
+<html lang="en"><head><meta charset="UTF-8"/></head><body>
+<div id="content"><h1 id="firstHeading"><i>{}</i> (season {})</h1>
+<table class="wikitable plainrowheaders wikiepisodetable"><tbody>
+<tr><th>No. overall</th><th>No. in season</th><th>Title</th></tr>
+"""
+SYNTH_ROW = """<tr class="vevent"><th scope="row">{}</th><td>{}</td>
+<td class="summary">"<a href="/wiki/Ep_{}">Episode {}: Part {}?</a>"</td></tr>
+<tr class="expand-child"><td colspan="3">A summary.</td></tr>
+"""
+SYNTH_TAIL = """</tbody></table></div></body></html>
+"""
+
+
+def gen_synth_page(n_eps):
+    """Generates a season page in the markup of the recorded pages, with a 
+    double episode every :data:`DOUBLE_EVERY` episodes.
+    
+    :param n_eps: The number of episode rows.
+    :return: The HTML of the page.
+    :rtype: string
+    """
+    rows = []
+    e_num = 1
+    
+    for idx in range(n_eps):
+        if idx % DOUBLE_EVERY == DOUBLE_EVERY - 1:
+            nums = "{}<hr/>{}".format(e_num, e_num + 1)
+            e_num += 2
+        else:
+            nums = str(e_num)
+            e_num += 1
+        rows.append(SYNTH_ROW.format(idx + 1, nums, idx, idx, idx % 7))
+    
+    return SYNTH_HEAD.format(SYNTH_SHOW, SYNTH_SEASON) + "".join(rows) \
+           + SYNTH_TAIL
+
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the pages of the fixture server from memory, as 
+    ``/wiki/<name>``."""
+    
+    def do_GET(self):
+        page = self.server.pages.get(self.path[len("/wiki/"):])
+        if page is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=UTF-8")
+        self.send_header("Content-Length", str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+    
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(pages):
+    """Starts the fixture server on a free local port, in a background 
+    thread.
+    
+    :param pages: The HTML of the pages to serve, by name.
+    :return: The server.
+    :rtype: :class:`http.server.ThreadingHTTPServer`
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), 
+                                             FixtureHandler)
+    server.pages = {name: html.encode("utf-8") for name, html in pages.items()}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def gen_dir(dir, s_num, e_nums):
+    """Generates a directory of empty video and subtitle files for a season, 
+    named in the styles of release groups and subtitle sites.
+    
+    :param dir: The directory to create the files in.
+    :param s_num: The season number.
+    :param e_nums: The list of numbers of all episodes, as scraped.
+    :return: The number of generated files.
+    :rtype: int
+    """
+    os.makedirs(dir)
+    
+    for nums in e_nums:
+        vid_eps = "".join("e{:0>2}".format(n) for n in nums)
+        sub_eps = "-".join("{:0>2}".format(n) for n in nums)
+        vid_fn = "show.name.s{:0>2}{}.720p.web.x264.mkv".format(s_num, vid_eps)
+        sub_fn = "Show Name - {}x{}.srt".format(s_num, sub_eps)
+        for fn in (vid_fn, sub_fn):
+            open(os.path.join(dir, fn), "w").close()
+    
+    return 2 * len(e_nums)
+
+
+def time_reps(func, reps, reset=None):
+    """Measures the wall time of a function.
+    
+    :param func: The function.
+    :param reps: The number of repetitions.
+    :param reset: A function called after each repetition, untimed.
+    :return: The median wall time in seconds, and the result of the last 
+        repetition.
+    :rtype: (float, object) tuple
+    """
+    times = []
+    
+    for _ in range(reps):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+        if reset is not None:
+            reset()
+    
+    return statistics.median(times), result
+
+
+def bench_page(link, sngl, expected, tmp_dir, reps):
+    """Benchmarks the stages of renaming a season's files.
+    
+    :param link: The link to the season's page on the fixture server.
+    :param sngl: Whether the page is of a single-season show.
+    :param expected: The number of episodes expected to be scraped.
+    :param tmp_dir: The directory to generate the files in.
+    :param reps: The number of repetitions.
+    :return: The median times of the stages and the found errors.
+    :rtype: dict
+    """
+    result = {"errors": []}
+    
+    result["get_show_info_s"], info = time_reps(
+        lambda: renamer.get_show_info(link, sngl=sngl), reps)
+    s_name, s_num, e_nums, e_names = info
+    
+    soup = bs4.BeautifulSoup(renamer.get_session().get(link).content, 
+                             "html.parser")
+    result["scrape_eps_s"], _ = time_reps(
+        lambda: renamer.scrape_eps(soup, sngl), reps)
+    
+    result["episodes"] = len(e_names)
+    if len(e_names) != expected:
+        result["errors"].append("Scraped {} episodes, expected {}."
+                                .format(len(e_names), expected))
+    
+    dir = os.path.join(tmp_dir, "season")
+    result["files"] = gen_dir(dir, s_num, e_nums)
+    show_info = vidsub.ShowInfo(link, s_name, s_num, e_nums, e_names)
+    
+    result["plan_s"], plan = time_reps(
+        lambda: vidsub.plan_renames(dir, "VS", show_info), reps)
+    
+    if len(plan.renames) != result["files"] or plan.unmatched \
+            or plan.positional:
+        result["errors"].append("Planned {} renames of {} files."
+                                .format(len(plan.renames), result["files"]))
+    
+    renames = renamer.plan_paths(plan.renames)
+    journal_fn = os.path.join(tmp_dir, "bench.journal")
+    
+    def reset():
+        renamer.undo_journal(journal_fn)
+        os.remove(journal_fn)
+        os.remove(journal_fn + renamer.UNDO_EXT)
+    
+    result["rename_s"], _ = time_reps(
+        lambda: renamer.journaled_rename(renames, journal_fn), reps, reset)
+    
+    shutil.rmtree(dir)
+    return result
+
+
+def get_args():
+    prog_desc = """Measure the stages of the renamer tool against recorded 
+                   and synthetic Wikipedia pages."""
+    reps_help = """Number of repetitions per stage. Default is 5."""
+    eps_help  = """Number of episode rows on the synthetic page. Default is 
+                   2000."""
+    
+    parser = argparse.ArgumentParser(prog="bench_renamer", 
+                                     description=prog_desc)
+    parser.add_argument("-n", "--reps", help=reps_help, type=int, default=5)
+    parser.add_argument("-e", "--episodes", help=eps_help, type=int, 
+                        default=2000)
+    args = parser.parse_args()
+    return args.reps, args.episodes
+
+
+def main():
+    reps, n_eps = get_args()
+    pages, cases = {}, {}
+    
+    for name, page in PAGES.items():
+        with open(os.path.join(FIXTURES_DIR, page["file"]), "r", 
+                  encoding="utf-8") as fr:
+            pages[name] = fr.read()
+        cases[name] = page["sngl"], page["episodes"]
+    
+    pages["synthetic"] = gen_synth_page(n_eps)
+    cases["synthetic"] = False, n_eps
+    
+    server = start_server(pages)
+    url = "http://127.0.0.1:{}/wiki/{{}}".format(server.server_port)
+    results = {"reps": reps, "pages": {}}
+    
+    try:
+        for name, (sngl, expected) in cases.items():
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                results["pages"][name] = bench_page(url.format(name), sngl, 
+                                                    expected, tmp_dir, reps)
+    finally:
+        server.shutdown()
+    
+    print(json.dumps(results, indent=2))
+    
+    if any(page["errors"] for page in results["pages"].values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
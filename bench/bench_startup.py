@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+A benchmark measuring the startup time of the command line tools. Each tool is 
+imported in a fresh interpreter, since that is what every CLI invocation pays 
+for, and the time is compared against a bare interpreter start. The benchmark 
+also makes sure that importing the renamer module doesn't pull in the network 
+and HTML parsing stacks, which are only needed when renaming video files.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                          os.pardir, "source")
+"""The directory containing the modules to benchmark."""
+
+MODULES = ["renamer", "subsync", "delaycalc", "randomise"]
+"""The modules whose import times are measured."""
+
+LAZY_MODULES = {"renamer": ["requests", "bs4"]}
+"""Modules that must not be loaded when importing the module of the key."""
+
+
+def run_python(code):
+    """Runs a snippet of code in a fresh Python interpreter with the source 
+    directory on its path.
+    
+    :param code: The code to run.
+    :raises subprocess.CalledProcessError: Raised if the code fails.
+    :return: The wall time in seconds the interpreter took, and its output.
+    :rtype: (float, string) tuple
+    """
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(SOURCE_DIR), 
+               PYTHONDONTWRITEBYTECODE="1")
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", code], env=env, check=True, 
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    return time.perf_counter() - start, out.stdout
+
+
+def time_import(module, reps):
+    """Measures the time of starting an interpreter and importing a module.
+    
+    :param module: The module to import, or None for a bare interpreter.
+    :param reps: The number of repetitions.
+    :return: The individual wall times in seconds.
+    :rtype: float list
+    """
+    code = "import {}".format(module) if module else "pass"
+    return [run_python(code)[0] for _ in range(reps)]
+
+
+def check_lazy(module, lazy):
+    """Checks which of the specified modules got loaded as a side effect of 
+    importing another module.
+    
+    :param module: The module to import.
+    :param lazy: The modules that should not be loaded.
+    :return: The modules that were loaded despite being lazy.
+    :rtype: string list
+    """
+    code = ("import sys, {}\n"
+            "print(' '.join(m for m in {!r} if m in sys.modules))"
+            .format(module, lazy))
+    return run_python(code)[1].split()
+
+
+def get_args():
+    prog_desc = """Measure the import time of the command line tools."""
+    reps_help = """Number of repetitions per module. Default is 10."""
+    
+    parser = argparse.ArgumentParser(prog="bench_startup", 
+                                     description=prog_desc)
+    parser.add_argument("-n", "--reps", help=reps_help, type=int, default=10)
+    return parser.parse_args().reps
+
+
+def main():
+    reps = get_args()
+    baseline = statistics.median(time_import(None, reps))
+    results = {"baseline_s": baseline, "modules": {}, "eager_imports": {}}
+    
+    for module in MODULES:
+        med = statistics.median(time_import(module, reps))
+        results["modules"][module] = {"median_s": med, 
+                                      "import_s": max(med - baseline, 0.0)}
+    
+    for module, lazy in LAZY_MODULES.items():
+        results["eager_imports"][module] = check_lazy(module, lazy)
+    
+    print(json.dumps(results, indent=2))
+    
+    if any(results["eager_imports"].values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
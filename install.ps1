@@ -13,7 +13,10 @@ function InstallScript([Parameter(Mandatory=$true)][string]$PyScript)
     Remove-Item -Path $removables -Recurse -Force
 }
 
-Get-ChildItem -Filter:.\source\*.py | % { 
+# Modules that are only imported by the tools, and not tools themselves
+$libraries = @("jsoncache", "perfstats", "vidprobe", "vidsub")
+
+Get-ChildItem -Filter:.\source\*.py | ? { $libraries -notcontains $_.BaseName } | % { 
     Write-Host "Installing: $_"
     InstallScript -PyScript:$_.FullName 
     Write-Host
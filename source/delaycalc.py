@@ -15,6 +15,8 @@ import re
 import datetime
 import math
 
+import perfstats
+
 
 SUPP_SUB_EXTS = [".srt"]
 
@@ -59,8 +61,10 @@ def get_args():
     parser.add_argument("file", help=file_help)
     parser.add_argument("time1", help=time1_help, type=int)
     parser.add_argument("time2", help=time2_help, type=int)
+    perfstats.add_arguments(parser)
     
     args = parser.parse_args()
+    perfstats.start("delaycalc", args.profile, args.profile_dump)
     file, time1, time2 = args.file, args.time1, args.time2
     
     if not os.path.isfile(file):
@@ -81,10 +85,11 @@ def get_args():
 def main():
     file, time1, time2 = get_args()
     
-    with open(file, "r") as fr:
+    with perfstats.phase("read"), open(file, "r") as fr:
         data = fr.read()
     
-    delay, growth = calc_delay(data, time1, time2)
+    with perfstats.phase("calc"):
+        delay, growth = calc_delay(data, time1, time2)
     print("Initial delay: {}, Growth: {}".format(delay, growth))
 
 
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+A module used by the tools for the JSON files in which they cache data 
+between runs, such as video file hashes, guessed Wikipedia page titles and 
+the library index. Files are written through a unique temporary file that 
+replaces the cache file once written, so that concurrent writers, such as the 
+worker threads of the service, never write to the same file.
+"""
+
+import json
+import os
+import tempfile
+
+
+def load(cache_fn):
+    """Loads a cache.
+    
+    :param cache_fn: The file in which the cache is kept.
+    :return: The cache, or an empty cache if the file doesn't exist or is 
+        unreadable.
+    :rtype: dict
+    """
+    try:
+        with open(cache_fn, "r", encoding="utf-8") as fr:
+            return json.load(fr)
+    except (OSError, ValueError):
+        return {}
+
+
+def save(cache, cache_fn, indent=None):
+    """Saves a cache, atomically replacing the file it's kept in.
+    
+    :param cache: The cache, as returned by :func:`load`.
+    :param cache_fn: The file in which the cache is kept.
+    :param indent: The indentation of the JSON, or None to write it compactly.
+    """
+    dir, base = os.path.split(os.path.abspath(cache_fn))
+    
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=dir, 
+                                     prefix=base + ".", suffix=".tmp", 
+                                     delete=False) as fw:
+        try:
+            json.dump(cache, fw, indent=indent, ensure_ascii=False)
+        except BaseException:
+            fw.close()
+            os.remove(fw.name)
+            raise
+    
+    os.replace(fw.name, cache_fn)
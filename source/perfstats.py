@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+A module used by the command line tools for profiling their runs. When 
+enabled, the wall time, CPU time, bytes read and written and number of calls 
+of each named phase of a run are recorded and written as JSON when the run 
+ends, optionally along with a :mod:`cProfile` dump of the whole run. When 
+disabled, entering a phase costs next to nothing.
+
+Calls of a phase may overlap, e.g. in concurrent threads. The wall time, CPU 
+time and I/O of a phase are measured over the periods in which any call of it 
+is running, so overlapping calls aren't counted twice, and the summed wall 
+time of the calls is recorded separately as the busy time.
+
+Profiling is enabled either with the '--profile' and '--profile-dump' command 
+line options added by :func:`add_arguments`, or with the environment variables 
+:data:`PROFILE_ENV` and :data:`PROFILE_DUMP_ENV`.
+"""
+
+import atexit
+import contextlib
+import os
+import sys
+import threading
+import time
+
+# cProfile and json are imported lazily by start() and stop(), since every 
+# tool imports this module, but few runs are profiled.
+
+
+PROFILE_ENV = "VIDSUB_PROFILE"
+"""The environment variable enabling profiling, specifying the file to write 
+the JSON profile to, or '-' for standard error."""
+
+PROFILE_DUMP_ENV = "VIDSUB_PROFILE_DUMP"
+"""The environment variable specifying the file to dump a :mod:`cProfile` 
+profile to."""
+
+IO_FN = "/proc/self/io"
+"""The file from which the bytes read and written by the process are read. 
+It's only available on Linux, elsewhere the byte counts are not recorded."""
+
+_profile = None
+"""The profile being recorded, or None if profiling is disabled."""
+
+_lock = threading.Lock()
+"""Guards the profile and the I/O overhead, since phases may be entered from 
+several threads."""
+
+_io_overhead = 0
+"""The number of bytes read by :func:`read_io` itself so far, which is left 
+out of the bytes read."""
+
+
+def read_io():
+    """Reads the number of bytes read and written by the process so far, 
+    excluding the bytes read by earlier calls of this function. Should be 
+    called while holding :data:`_lock`.
+    
+    :return: The number of bytes read and written, or None if unavailable.
+    :rtype: (int, int) tuple
+    """
+    global _io_overhead
+    
+    try:
+        with open(IO_FN, "rb") as fr:
+            data = fr.read()
+        counters = dict(line.split(": ") for line in data.decode().split("\n") 
+                        if line)
+        rchar, wchar = int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+    
+    # The counters are read before this read is accounted for.
+    rchar -= _io_overhead
+    _io_overhead += len(data)
+    return rchar, wchar
+
+
+def measure():
+    """Takes a measurement of the wall time, CPU time and I/O of the process.
+    
+    :return: The wall time, CPU time, and bytes read and written (or None if 
+        unavailable).
+    :rtype: (float, float, (int, int) tuple) tuple
+    """
+    return time.perf_counter(), time.process_time(), read_io()
+
+
+def add_measurement(stats, start, end):
+    """Adds the difference between two measurements to a statistics dict.
+    
+    :param stats: The statistics dict.
+    :param start: The measurement taken at the start, see :func:`measure`.
+    :param end: The measurement taken at the end, see :func:`measure`.
+    """
+    stats["wall_s"] += end[0] - start[0]
+    stats["cpu_s"] += end[1] - start[1]
+    
+    if start[2] is not None and end[2] is not None:
+        stats["bytes_read"] += end[2][0] - start[2][0]
+        stats["bytes_written"] += end[2][1] - start[2][1]
+
+
+def new_stats():
+    """Creates an empty statistics dict.
+    
+    :return: The statistics dict.
+    :rtype: dict
+    """
+    return {"calls": 0, "wall_s": 0.0, "busy_s": 0.0, "cpu_s": 0.0, 
+            "bytes_read": 0, "bytes_written": 0}
+
+
+@contextlib.contextmanager
+def phase(name):
+    """A context manager recording the time and I/O spent within it as a 
+    call of the named phase. Phases may be nested, in which case the inner 
+    phase is also accounted for by the outer one. Overlapping calls of the 
+    same phase are measured once, see the module documentation.
+    
+    :param name: The name of the phase.
+    """
+    profile = _profile
+    
+    if profile is None:
+        yield
+        return
+    
+    with _lock:
+        start = measure()
+        active = profile["active"].setdefault(name, [0, start])
+        if active[0] == 0:
+            active[1] = start
+        active[0] += 1
+    
+    try:
+        yield
+    finally:
+        with _lock:
+            end = measure()
+            stats = profile["phases"].setdefault(name, new_stats())
+            stats["calls"] += 1
+            stats["busy_s"] += end[0] - start[0]
+            active[0] -= 1
+            if active[0] == 0:
+                add_measurement(stats, active[1], end)
+
+
+def count(name, n=1):
+    """Counts calls of a named phase without timing them, for operations 
+    that are too frequent or too short to time individually.
+    
+    :param name: The name of the phase.
+    :param n: The number of calls to count.
+    """
+    if _profile is not None:
+        with _lock:
+            _profile["phases"].setdefault(name, new_stats())["calls"] += n
+
+
+def add_arguments(parser):
+    """Adds the profiling options to a command line argument parser.
+    
+    :param parser: The :class:`argparse.ArgumentParser` to add options to.
+    """
+    prof_help = """Profile the run and write the JSON profile to the specified 
+                   file, or '-' for standard error. Can also be enabled with 
+                   the {} environment variable.""".format(PROFILE_ENV)
+    dump_help = """Dump a cProfile profile of the run to the specified file. 
+                   Can also be enabled with the {} environment 
+                   variable.""".format(PROFILE_DUMP_ENV)
+    
+    parser.add_argument("--profile", help=prof_help, metavar="FILE")
+    parser.add_argument("--profile-dump", help=dump_help, metavar="FILE")
+
+
+def start(prog, profile_fn=None, dump_fn=None):
+    """Starts profiling the run, if enabled by the parameters or by the 
+    environment variables. The profile is written when the process exits.
+    
+    :param prog: The name of the program being profiled.
+    :param profile_fn: The file to write the JSON profile to, or '-' for 
+        standard error (optional, read from :data:`PROFILE_ENV` if not 
+        specified).
+    :param dump_fn: The file to dump a :mod:`cProfile` profile to (optional, 
+        read from :data:`PROFILE_DUMP_ENV` if not specified).
+    """
+    global _profile
+    
+    profile_fn = profile_fn or os.environ.get(PROFILE_ENV)
+    dump_fn = dump_fn or os.environ.get(PROFILE_DUMP_ENV)
+    
+    if _profile is not None or not (profile_fn or dump_fn):
+        return
+    
+    profiler = None
+    if dump_fn:
+        import cProfile
+        profiler = cProfile.Profile()
+    
+    with _lock:
+        _profile = {"prog": prog, "argv": sys.argv[1:], "phases": {}, 
+                    "active": {}, "profile_fn": profile_fn, 
+                    "dump_fn": dump_fn, "profiler": profiler, 
+                    "start": measure()}
+    
+    if profiler is not None:
+        profiler.enable()
+    
+    atexit.register(stop)
+
+
+def stop():
+    """Stops profiling and writes the profile, if profiling was started."""
+    global _profile
+    
+    if _profile is None:
+        return
+    
+    profile, _profile = _profile, None
+    
+    if profile["profiler"] is not None:
+        profile["profiler"].disable()
+        profile["profiler"].dump_stats(profile["dump_fn"])
+    
+    if not profile["profile_fn"]:
+        return
+    
+    import json
+    
+    total = new_stats()
+    total["calls"] = 1
+    with _lock:
+        add_measurement(total, profile["start"], measure())
+    total["busy_s"] = total["wall_s"]
+    
+    data = {"prog": profile["prog"], "argv": profile["argv"], 
+            "total": total, "phases": profile["phases"]}
+    
+    if profile["profile_fn"] == "-":
+        json.dump(data, sys.stderr, indent=2)
+        sys.stderr.write("\n")
+    else:
+        with open(profile["profile_fn"], "w", encoding="utf-8") as fw:
+            json.dump(data, fw, indent=2)
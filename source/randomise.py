@@ -3,20 +3,86 @@
 
 """
 A module for starting a random video file in a given top directory, using the 
-video file's default media player.
+video file's default media player. The video files can be filtered by their 
+path, duration, resolution and codec, and by whether they have been started 
+before, using the metadata in the library index of the :mod:`vidprobe` 
+module. The candidates are selected from the directory and library indices 
+without touching the files; files are only probed when they aren't indexed 
+yet, and the offered file is checked against its current metadata.
 """
 
+import argparse
 import os
-import glob
 import random
 
+import jsoncache
+import perfstats
+import vidprobe
 
-SUPP_VID_EXTS = [".avi", ".mp4", ".mkv", ".m4v"]
 
+def has_info_filters(filters):
+    return any(f is not None for f in filters[2:])
 
-def randomise():
-    vid_files = [f for f in glob.glob(r".\**\*.*", recursive=True) \
-                 if os.path.splitext(f)[1] in SUPP_VID_EXTS]
+
+def info_matches(info, filters):
+    _, _, min_dur, max_dur, min_height, codec = filters
+    
+    if min_dur is not None and (info.duration or 0) < min_dur * 60:
+        return False
+    if max_dur is not None and (info.duration is None \
+                                or info.duration > max_dur * 60):
+        return False
+    if min_height is not None and (info.height or 0) < min_height:
+        return False
+    if codec is not None and info.codec != vidprobe.norm_codec(codec):
+        return False
+    
+    return True
+
+
+def matches(f, library, filters):
+    show, unwatched = filters[:2]
+    
+    if show is not None and show.lower() not in os.path.relpath(f).lower():
+        return False
+    
+    entry = vidprobe.get_entry(f, library)
+    
+    if unwatched and entry is not None and entry.get("played"):
+        return False
+    
+    if not has_info_filters(filters):
+        return True
+    
+    # Files are only touched if they've never been probed.
+    info = vidprobe.get_indexed_info(f, library)
+    if info is None:
+        try:
+            info = vidprobe.get_media_info(f, library)
+        except OSError:
+            return False
+    
+    return info_matches(info, filters)
+
+
+def is_current_match(f, library, filters):
+    if not has_info_filters(filters):
+        return os.path.exists(f)
+    
+    try:
+        return info_matches(vidprobe.get_media_info(f, library), filters)
+    except OSError:
+        return False
+
+
+def randomise(filters):
+    library = jsoncache.load(vidprobe.LIBRARY_FN)
+    dir_index = jsoncache.load(vidprobe.DIR_INDEX_FN)
+    
+    with perfstats.phase("scan"):
+        vid_files = vidprobe.scan_tree(".", dir_index)
+    
+    jsoncache.save(dir_index, vidprobe.DIR_INDEX_FN)
     
     if len(vid_files) == 0:
         print("No video files found.")
@@ -24,16 +90,59 @@ def randomise():
     
     random.shuffle(vid_files)
     
-    for f in vid_files:
-        if input("{}? [y/N] ".format(f)).lower() == "y":
-            os.startfile(f)
-            return
+    try:
+        for f in vid_files:
+            with perfstats.phase("filter"):
+                if not matches(f, library, filters) \
+                        or not is_current_match(f, library, filters):
+                    continue
+            with perfstats.phase("confirm"):
+                answer = input("{}? [y/N] ".format(os.path.relpath(f)))
+            if answer.lower() == "y":
+                vidprobe.set_played(f, library)
+                os.startfile(f)
+                return
+        
+        print("No more video files.")
+    finally:
+        jsoncache.save(library, vidprobe.LIBRARY_FN)
+
 
-    print("No more video files.")
+def get_args():
+    prog_desc = """Start a random video file in the current directory or its 
+                   subdirectories."""
+    show_help = """Only start video files whose path contains the given text, 
+                   e.g. the name of a show. Case insensitive."""
+    unw_help  = """Only start video files that haven't been started 
+                   before."""
+    mind_help = """Only start video files at least the given number of 
+                   minutes long."""
+    maxd_help = """Only start video files at most the given number of 
+                   minutes long."""
+    res_help  = """Only start video files whose height is at least the given 
+                   number of pixels, e.g. 720."""
+    cod_help  = """Only start video files with the given video codec, e.g. 
+                   h264 or hevc."""
+    
+    parser = argparse.ArgumentParser(prog="randomise", description=prog_desc)
+    parser.add_argument("-s", "--show", help=show_help)
+    parser.add_argument("-u", "--unwatched", help=unw_help, 
+                        action="store_true")
+    parser.add_argument("--min-duration", help=mind_help, type=float)
+    parser.add_argument("--max-duration", help=maxd_help, type=float)
+    parser.add_argument("--min-height", help=res_help, type=int)
+    parser.add_argument("-c", "--codec", help=cod_help)
+    perfstats.add_arguments(parser)
+    
+    args = parser.parse_args()
+    perfstats.start("randomise", args.profile, args.profile_dump)
+    
+    return (args.show, args.unwatched, args.min_duration, args.max_duration, 
+            args.min_height, args.codec)
 
 
 def main():
-    randomise()
+    randomise(get_args())
 
 
 if __name__ == "__main__":
@@ -1,12 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-
-# TODO
-# - Wikipedia URLs are case sensitive, e.g. "Under the Dome" (correct) vs. 
-#   Under The Dome (wrong). Add support for this in the capwords function.
-
-
 """
 A module used for renaming video and subtitle files of a specific season of a 
 specified show. Video files are renamed by scraping the Wikipedia page for the 
@@ -15,10 +9,26 @@ sure that they are auto-loaded in media players.
 """
 
 import argparse
-import requests
-import bs4
+import concurrent.futures
+import functools
+import json
+import math
+import mmap
 import os
 import re
+import string
+import struct
+import sys
+import tempfile
+import threading
+import uuid
+
+import jsoncache
+import perfstats
+
+# The network and HTML parsing stacks (requests, bs4) are imported lazily by 
+# the functions that need them, since they dominate the startup time and are 
+# never used when only renaming subtitle files.
 
 
 SUPP_VID_EXTS = [".avi", ".mp4", ".mkv", ".m4v"]
@@ -36,6 +46,138 @@ names of any show actually contains those characters, it is included as an
 unsupported character to make sure it is removed from episode names scraped 
 from Wikipedia."""
 
+SANITISE_TABLE = str.maketrans("", "", "".join(UNSUPP_FN_CHARS))
+"""The translation table used by :func:`sanitise_fn` to remove the characters 
+in :data:`UNSUPP_FN_CHARS`, built once instead of per name."""
+
+MAX_PATH = 260
+"""The maximum length of a path on Windows, including the terminating null 
+character. Longer paths can't be opened by most programs."""
+
+NAME_TEMPLATE = "{show} S{season:0>2}E{episode:0>2}{extra} - {name}"
+"""The default template of video filenames, formatted using the fields 
+`show`, `season`, `episode`, `extra` and `name`. The `episode` field is the 
+first episode number, and the `extra` field holds the further episode numbers 
+of double episodes, each formatted using :data:`EXTRA_TEMPLATE`."""
+
+EXTRA_TEMPLATE = "-{episode:0>2}"
+"""The template of each further episode number of double episodes in the 
+`extra` field of :data:`NAME_TEMPLATE`."""
+
+TEMPLATE_FIELDS = ["show", "season", "episode", "extra", "name"]
+"""The fields available to templates of video filenames."""
+
+HASH_CHUNK_SIZE = 64 * 1024
+"""The size in bytes of the chunks at the head and tail of a video file that 
+are used to compute its hash."""
+
+HASH_CACHE_FN = os.path.join(os.path.expanduser("~"), ".vidsub_hashes.json")
+"""The file in which computed video file hashes are cached between runs, 
+mapping absolute paths to their size, modification time and hash."""
+
+SUB_HASHES_FN = "subhashes.json"
+"""The name of the sidecar file that may exist in a directory, mapping the 
+subtitle files in it to the hashes of the video files they belong to, for 
+example as recorded by a subtitle downloader."""
+
+WIKI_URL = "https://en.wikipedia.org/wiki/{}"
+"""The format of links to Wikipedia pages, given the page title."""
+
+LINK_CACHE_FN = os.path.join(os.path.expanduser("~"), ".vidsub_links.json")
+"""The file in which the Wikipedia page titles successfully guessed for shows 
+are cached between runs, mapping lowercase show names to the title formats of 
+their single season page and season pages."""
+
+LOWER_WORDS = ["a", "an", "and", "as", "at", "but", "by", "for", "from", "in", 
+               "nor", "of", "on", "or", "the", "to", "with"]
+"""Defines the words that are written in lowercase in Wikipedia titles, 
+unless they are the first word of the title."""
+
+SNGL_TITLE_FSTRS = ["{}", "{}_(TV_series)", "{}_(miniseries)"]
+"""The formats of Wikipedia page titles of shows with only one season, given 
+the show's title, in order of likelihood."""
+
+SEASON_TITLE_FSTRS = ["{}_(season_{{}})", "{}_(TV_series)_(season_{{}})", 
+                      "{}_(series_{{}})"]
+"""The formats of Wikipedia page titles of a show's seasons, given the show's 
+title, in order of likelihood. The formatted titles contain a '{}' field for 
+the season number."""
+
+PROBE_WORKERS = 8
+"""The maximum number of concurrent requests when probing guessed links."""
+
+PROBE_TIMEOUT = 3
+"""The timeout in seconds of the requests probing guessed links. Abandoned 
+probes keep running until they finish, so it bounds how long exiting waits 
+for them."""
+
+JOURNAL_EXT = ".journal"
+"""The file extension appended to a plan's filename to get the filename of 
+the journal written when applying the plan."""
+
+UNDO_EXT = ".undo"
+"""The file extension appended to a journal's filename to get the filename of 
+the journal written when undoing the renames of the journal."""
+
+_local = threading.local()
+"""The thread-local storage holding the :class:`requests.Session` of each 
+thread, created on first use by :func:`get_session`."""
+
+SXEY_PATTERN = re.compile(r"^(.*?)s(\d+)ep?(\d+)((?:(?:-|-?ep?)\d+(?![\dp]))*)"
+                          r".*?$", re.IGNORECASE)
+"""Matches filenames where the show name is followed by season and episode 
+numbers such as S03E14, capturing the show name, the season number, the 
+episode number and any further episode numbers of double episodes (such as 
+S03E14E15, S03E14-E15 or S03E14-15)."""
+
+XXY_PATTERN = re.compile(r"^(.*?)(\d+)x(\d+)((?:-(?:\d+x)?\d+(?![\dp]))*)"
+                         r".*?$", re.IGNORECASE)
+"""Matches filenames where the show name is followed by season and episode 
+numbers such as 3x14, capturing the same groups as :data:`SXEY_PATTERN` (such 
+as 3x14-15 or 3x14-3x15 for double episodes)."""
+
+EP_PATTERNS = [SXEY_PATTERN, XXY_PATTERN]
+"""The patterns tried, in order, when parsing episode numbers from 
+filenames."""
+
+LANG_CODES = set(["ar", "bg", "cs", "da", "de", "el", "en", "es", "et", "fa", 
+                  "fi", "fr", "he", "hi", "hr", "hu", "id", "is", "it", "ja", 
+                  "ko", "lt", "lv", "ms", "nb", "nl", "no", "pl", "pt", "ro", 
+                  "ru", "sk", "sl", "sr", "sv", "th", "tr", "uk", "vi", "zh", 
+                  "ara", "bul", "ces", "chi", "cze", "dan", "deu", "dut", 
+                  "ell", "eng", "est", "fas", "fin", "fra", "fre", "ger", 
+                  "gre", "heb", "hin", "hrv", "hun", "ice", "ind", "isl", 
+                  "ita", "jpn", "kor", "lav", "lit", "may", "msa", "nld", 
+                  "nob", "nor", "per", "pol", "por", "ron", "rum", "rus", 
+                  "slk", "slo", "slv", "spa", "srp", "swe", "tha", "tur", 
+                  "ukr", "vie", "zho"])
+"""The ISO 639-1 and 639-2 language codes recognised in subtitle filename 
+suffixes."""
+
+LANG_PATTERN = re.compile(r"\.([a-z]{2,3})(?:[-_][A-Za-z]{2,4})?"
+                          r"(?:\.(?:forced|sdh|hi|cc))*$")
+"""Matches language suffixes of subtitle basenames, such as .en, .pt-BR or 
+.eng.forced, capturing the language code. Only lowercase codes are matched, 
+so that capitalised words at the end of episode names aren't mistaken for 
+languages."""
+
+TOKEN_PATTERN = re.compile(r"[0-9a-z]+")
+"""Matches the tokens of lowercased basenames, used for pairing subtitle files 
+with video files by name."""
+
+MAX_CANDIDATE_DF = 64
+"""The maximum number of video files sharing a token for the token to be used 
+to find pairing candidates. More common tokens, such as the show name in a 
+directory of a whole season, still count towards the pairing scores."""
+
+MAX_CANDIDATES = 8
+"""The maximum number of best scoring video files considered for pairing 
+with each subtitle file."""
+
+MIN_PAIR_SCORE = 0.5
+"""The minimum score for pairing a subtitle file with a video file, see 
+:func:`pair_subs_by_tokens`."""
+
 
 def sanitise_fn(fn):
     """Sanitises a string to become a valid filename in the Windows OS, 
@@ -45,8 +187,7 @@ def sanitise_fn(fn):
     :return: The sanitised string.
     :rtype: string
     """
-    pattern = "[{}]".format(re.escape("".join(UNSUPP_FN_CHARS)))
-    return re.sub(pattern, "", fn, flags=re.IGNORECASE)
+    return fn.translate(SANITISE_TABLE)
 
 
 def capwords(text, seps):
@@ -64,6 +205,111 @@ def capwords(text, seps):
     return text
 
 
+def gen_title_cases(s_name):
+    """Generates the different ways a show name might be cased in a Wikipedia 
+    page title, since the titles are case sensitive, e.g. "Under the Dome" 
+    (correct) vs. "Under The Dome" (wrong).
+    
+    :param s_name: The show name.
+    :return: The distinct casings of the show name, with spaces replaced by 
+        underscores, in order of likelihood.
+    :rtype: string list
+    """
+    words = s_name.split()
+    lowered = words[:1] + [w.lower() if w.lower() in LOWER_WORDS else w \
+                           for w in words[1:]]
+    sentence = words[:1] + [w.lower() for w in words[1:]]
+    cases = []
+    
+    for case in [lowered, words, sentence]:
+        title = "_".join(case)
+        if title and title not in cases:
+            cases.append(title)
+    
+    return cases
+
+
+def gen_title_fstrs(s_name, sngl=False):
+    """Generates candidate formats of the Wikipedia page title of a show's 
+    season, combining the casings from :func:`gen_title_cases` with the 
+    formats in :data:`SNGL_TITLE_FSTRS` or :data:`SEASON_TITLE_FSTRS`. Braces 
+    in the show name are escaped, so the formats are always formatted with 
+    the season number, even if `sngl` is set.
+    
+    :param s_name: The show name.
+    :param sngl: Denoting that the show only has one season.
+    :return: The candidate title formats, with a '{}' field for the season 
+        number unless `sngl` is set, in order of likelihood.
+    :rtype: string list
+    """
+    fstrs = SNGL_TITLE_FSTRS if sngl else SEASON_TITLE_FSTRS
+    cases = [case.replace("{", "{{").replace("}", "}}") \
+             for case in gen_title_cases(s_name)]
+    return [fstr.format(case) for fstr in fstrs for case in cases]
+
+
+def get_session():
+    """Gets the :class:`requests.Session` of the calling thread, shared by all 
+    its requests, so that connections are pooled and kept alive between 
+    requests, creating it on first use. Sessions aren't thread-safe, so each 
+    thread, e.g. each worker of the service, gets its own.
+    
+    :return: The session of the calling thread.
+    :rtype: :class:`requests.Session`
+    """
+    import requests
+    
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    
+    return _local.session
+
+
+def probe_link(link):
+    """Checks whether a link exists, using a HEAD request. The request is 
+    made with its own connection, which is closed once it's done, since the 
+    probing threads are discarded afterwards.
+    
+    :param link: The link to check.
+    :return: True if the request succeeds, False otherwise.
+    :rtype: bool
+    """
+    import requests
+    
+    try:
+        with perfstats.phase("probe"):
+            response = requests.head(link, timeout=PROBE_TIMEOUT)
+            return response.status_code == 200
+    except requests.RequestException:
+        return False
+
+
+def probe_links(links):
+    """Checks which of a list of links exist, concurrently using 
+    :func:`probe_link`, returning as soon as the first existing link in the 
+    list is known, i.e. once it's found to exist and all links before it are 
+    found not to. The remaining probes are abandoned, and time out after 
+    :data:`PROBE_TIMEOUT`.
+    
+    :param links: The links to check, in order of preference.
+    :return: The first link in the list that exists, or None if none of them 
+        exist.
+    :rtype: string
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(PROBE_WORKERS)
+    
+    try:
+        futures = [executor.submit(probe_link, link) for link in links]
+        
+        for link, future in zip(links, futures):
+            if future.result():
+                return link
+        
+        return None
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
 def match_sXeY(vid_files):
     """Tries to find video files with filenames of a format such that the 
     show name is followed by a string defining season and episode number, such 
@@ -74,10 +320,8 @@ def match_sXeY(vid_files):
         or None if no match was found.
     :rtype: string tuple
     """
-    match_format = "^(.*?)s(\d+)ep?\d+.*?$"
-    
     for fn in vid_files:
-        match = re.search(match_format, fn, flags=re.IGNORECASE)
+        match = SXEY_PATTERN.search(fn)
         if match is not None:
             return match.group(1), match.group(2)
     
@@ -94,21 +338,102 @@ def match_XxY(vid_files):
         or None if no match was found.
     :rtype: string tuple
     """
-    match_format = "^(.*?)(\d+)x\d+.*?$"
-    
     for fn in vid_files:
-        match = re.search(match_format, fn, flags=re.IGNORECASE)
+        match = XXY_PATTERN.search(fn)
         if match is not None:
             return match.group(1), match.group(2)
     
     return None
 
 
-def match_show_snum(dir):
+def parse_ep_keys(fn):
+    """Parses the season and episode numbers from a filename, using the 
+    patterns in :data:`EP_PATTERNS`.
+    
+    :param fn: The filename to parse.
+    :return: The keys of the episodes that the file contains, as (season 
+        number, episode number) tuples, more than one for double episodes, 
+        or None if the filename contains no episode numbers.
+    :rtype: (int, int) tuple list
+    """
+    for pattern in EP_PATTERNS:
+        match = pattern.search(fn)
+        if match is not None:
+            s_num = int(match.group(2))
+            e_nums = [match.group(3)] + re.findall(r"(\d+)(?=-|e|$)", 
+                                                   match.group(4), 
+                                                   flags=re.IGNORECASE)
+            return [(s_num, int(e_num)) for e_num in e_nums]
+    
+    return None
+
+
+def gen_ep_keys(s_num, e_nums):
+    """Generates the episode keys of scraped episodes, on the same form as 
+    the ones returned by :func:`parse_ep_keys`.
+    
+    :param s_num: The number of the season.
+    :param e_nums: The list of numbers of all episodes. Each number is a list 
+        itself, to take into account the possibility of double episodes.
+    :return: The list of keys of each episode.
+    :rtype: (int, int) tuple list list
+    """
+    ep_keys = []
+    
+    for e_num_list in e_nums:
+        keys = []
+        for e_num in e_num_list:
+            match = re.search(r"\d+", e_num)
+            if match is not None:
+                keys.append((s_num, int(match.group())))
+        ep_keys.append(keys)
+    
+    return ep_keys
+
+
+def match_files_names(files, name_keys, names):
+    """Pairs files with new names by their episode keys instead of by 
+    position, so a missing or unparsable file doesn't shift the names of 
+    every file after it. A file is paired with the name sharing any of its 
+    episode keys, which makes double episodes match regardless of whether 
+    the file is named after one or both of its episodes.
+    
+    :param files: The filenames to pair with names.
+    :param name_keys: The list of episode keys of each name.
+    :param names: The list of new names.
+    :return: The list of paired files and names, as (file, name) tuples, and 
+        the list of files that couldn't be paired with any name. A file is 
+        unpaired if it has no episode numbers, if no name has its episode 
+        numbers, or if the name has already been paired with another file.
+    :rtype: ((string, string) tuple list, string list) tuple
+    """
+    name_idxs = {}
+    for idx, keys in enumerate(name_keys):
+        for key in keys:
+            name_idxs.setdefault(key, idx)
+    
+    pairs, unmatched, taken = [], [], set()
+    
+    for fn in files:
+        idxs = [name_idxs[key] for key in parse_ep_keys(fn) or [] \
+                if key in name_idxs]
+        
+        if not idxs or idxs[0] in taken:
+            unmatched.append(fn)
+            continue
+        
+        taken.add(idxs[0])
+        pairs.append((fn, names[idxs[0]]))
+    
+    return pairs, unmatched
+
+
+def match_show_snum(snap):
     """Uses the video files in the specified directory to match out the show's 
     name and season number.
     
-    :param dir: The directory in which to look for video files.
+    :param snap: The :class:`DirSnapshot` of the directory in which to look 
+        for video files.
     :raises AssertionError: Raised if the name of the video files on which to 
         perform the match are of a format such that a valid match can't be 
         made.
@@ -116,7 +441,7 @@ def match_show_snum(dir):
     :rtype: (string, int) tuple
     """
     match_funcs = [match_sXeY, match_XxY]
-    vid_files = get_vid_files(dir)
+    vid_files = get_vid_files(snap)
     
     for mf in match_funcs:
         match = mf(vid_files)
@@ -135,12 +460,13 @@ def match_show_snum(dir):
     return s_name, s_num
 
 
-def guess_link(dir, s_name=None, s_num=None, sngl=False):
+def guess_link(snap, s_name=None, s_num=None, sngl=False):
     """Uses the video files in the specified directory to guess the Wikipedia 
     link to the correct series and season, where the episode names can be 
     found.
     
-    :param dir: The directory in which to look for video files.
+    :param snap: The :class:`DirSnapshot` of the directory in which to look 
+        for video files.
     :param s_name: The show name (optional, an attempt to match it from the 
         filenames it will be made if not specified).
     :param s_num: The season number (optional, an attempt to match it from the 
@@ -149,31 +475,44 @@ def guess_link(dir, s_name=None, s_num=None, sngl=False):
         the link to the Wikipedia page has a different structure then).
     :raises AssertionError: Raised if the name of the video file on which the 
         guess is based is of a format such that a valid guess can't be 
-        performed.
+        performed, or if none of the guessed links exist.
     :return: The guessed Wikipedia link along with the show name and season 
         number matched from filenames (if not specified).
     :rtype: (string, string, int) tuple
     """
     # Match functions should return two strings, show name and season number
     if None in (s_name, s_num):
-        s_name, s_num = match_show_snum(dir)
+        s_name, s_num = match_show_snum(snap)
     
-    if sngl:
-        link_fstr = "https://en.wikipedia.org/wiki/{}"
-        link = link_fstr.format(s_name.replace(" ", "_"))
-    else:
-        link_fstr = "https://en.wikipedia.org/wiki/{}_(season_{})"
-        link = link_fstr.format(s_name.replace(" ", "_"), s_num)
+    # Titles that have been guessed before are tried on their own first, so 
+    # that later seasons of a show only require a single request.
+    cache = jsoncache.load(LINK_CACHE_FN)
+    entry = cache.setdefault(s_name.lower(), {})
+    kind = "single" if sngl else "season"
+    
+    fstrs = gen_title_fstrs(s_name, sngl)
+    links = [WIKI_URL.format(fstr.format(s_num)) for fstr in fstrs]
+    link = None
+    
+    with perfstats.phase("guess_link"):
+        if kind in entry:
+            link = probe_links([WIKI_URL.format(entry[kind].format(s_num))])
         
-    assert requests.get(link).status_code == 200
+        if link is None:
+            link = probe_links(links)
+            assert link is not None
+            entry[kind] = fstrs[links.index(link)]
+            jsoncache.save(cache, LINK_CACHE_FN, indent=2)
+    
     return link, s_name, s_num
 
 
-def try_guess_link(dir, s_name=None, s_num=None, sngl=False):
+def try_guess_link(snap, s_name=None, s_num=None, sngl=False):
     """Uses the :func:`guess_link` function to guess the Wikipedia link, 
     catching any raised errors.
     
-    :param dir: The directory in which to look for video files.
+    :param snap: The :class:`DirSnapshot` of the directory in which to look 
+        for video files.
     :param s_name: The show name (optional, an attempt to match it from the 
         filenames it will be made if not specified).
     :param s_num: The season number (optional, an attempt to match it from the 
@@ -187,7 +526,7 @@ def try_guess_link(dir, s_name=None, s_num=None, sngl=False):
     """
     try:
         print("\nGuessing link to show...")
-        link, s_name, s_num = guess_link(dir, s_name, s_num, sngl)
+        link, s_name, s_num = guess_link(snap, s_name, s_num, sngl)
         print("Guessed link: {}".format(link))
         return link, s_name, s_num
     except:
@@ -269,13 +608,19 @@ def get_show_info(link, s_name=None, s_num=None, sngl=False):
         names of the season's episodes.
     :rtype: string list
     """
-    page = requests.get(link)
-    soup = bs4.BeautifulSoup(page.content, "html.parser")
+    import bs4
     
-    if None in (s_name, s_num):
-        s_name, s_num = scrape_show_snum(soup, sngl)
+    with perfstats.phase("fetch"):
+        page = get_session().get(link)
+    
+    with perfstats.phase("parse"):
+        soup = bs4.BeautifulSoup(page.content, "html.parser")
     
-    e_nums, e_names = scrape_eps(soup, sngl)
+    with perfstats.phase("scrape"):
+        if None in (s_name, s_num):
+            s_name, s_num = scrape_show_snum(soup, sngl)
+        
+        e_nums, e_names = scrape_eps(soup, sngl)
     
     return s_name, s_num, e_nums, e_names
 
@@ -311,51 +656,379 @@ def get_ep_names(link):
     :return: The names of the season's episodes.
     :rtype: string list
     """
+    import requests
+    import bs4
+    
     page = requests.get(link)
     soup = bs4.BeautifulSoup(page.content, "html.parser")
     selector = "table.wikiepisodetable > tbody > tr.vevent > td.summary"
     return [el.text.strip('"') for el in soup.select(selector)]
 
 
-def gen_vid_filenames(s_name, s_num, e_nums, e_names):
-    """Generates the video filenames based on a specific format string.
+@functools.lru_cache(maxsize=None)
+def compile_template(template=NAME_TEMPLATE):
+    """Validates a template of video filenames once, and returns the function 
+    formatting it, so that whole episode lists are formatted without 
+    validating or rebuilding the template per name.
+    
+    :param template: The template, see :data:`NAME_TEMPLATE`.
+    :raises ValueError: Raised if the template is malformed, uses fields not 
+        in :data:`TEMPLATE_FIELDS`, or contains characters in 
+        :data:`UNSUPP_FN_CHARS` outside of its fields.
+    :return: The function formatting the template with keyword arguments.
+    :rtype: function
+    """
+    for _, field, _, _ in string.Formatter().parse(template):
+        if field is not None and field not in TEMPLATE_FIELDS:
+            raise ValueError("Unknown field '{{{}}}' in template, use any of "
+                             "{}.".format(field, ", ".join(TEMPLATE_FIELDS)))
+    
+    try:
+        sample = template.format(show="", season=1, episode=1, extra="", 
+                                 name="")
+    except (ValueError, IndexError) as e:
+        raise ValueError("Invalid template: {}".format(e)) from e
+    
+    # The fields are sanitised, but the literal text (and fill characters) 
+    # of the template isn't, so it must not contain unsupported characters.
+    unsupp = [c for c in UNSUPP_FN_CHARS if c in sample]
+    if unsupp:
+        raise ValueError("Unsupported characters {} in template."
+                         .format(" ".join(unsupp)))
+    
+    return template.format
+
+
+def gen_vid_filenames(s_name, s_num, e_nums, e_names, 
+                      template=NAME_TEMPLATE):
+    """Generates the video filenames of a whole list of episodes based on a 
+    template, see :func:`compile_template`.
     
     :param s_name: The name of the show.
     :param s_num: The number of the season.
     :param e_nums: The list of numbers of all episodes. Each number is a list 
         itself, to take into account the possibility of double episodes.
     :param e_names: The list of names of all episodes.
+    :param template: The template of the filenames.
     :return: The list of names of all episode in the season.
     :rtype: string list
     """
-    return ["{} S{:0>2}E{:0>2}X - {}" \
-            .replace("X", "-{:0>2}" * (len(e_num_list)-1)) \
-            .format(s_name, s_num, *e_num_list, e_name) \
-            for e_num_list, e_name in zip(e_nums, e_names)]
+    fmt = compile_template(template)
+    extra_fmt = EXTRA_TEMPLATE.format
+    show = sanitise_fn(s_name)
+    names = []
+    
+    for e_num_list, e_name in zip(e_nums, e_names):
+        first, *rest = [int(n) if n.isdigit() else n for n in e_num_list]
+        extra = "".join([extra_fmt(episode=n) for n in rest]) if rest else ""
+        names.append(fmt(show=show, season=s_num, episode=first, extra=extra, 
+                         name=e_name))
+    
+    return names
+
+
+class DirSnapshot:
+    """A snapshot of the files in a directory, listed once and shared by all 
+    stages of a renaming run, since listing directories on network mounts can 
+    be slow. The files are bucketed by file extension and their basenames are 
+    precomputed. The snapshot is kept up to date by registering the renames 
+    performed through it, or relisted with :meth:`refresh`.
+    
+    :param dir: The directory to take a snapshot of.
+    """
+    
+    def __init__(self, dir):
+        self.dir = dir
+        self.refresh()
+    
+    def refresh(self):
+        """Lists the directory and rebuilds the extension buckets and 
+        basenames."""
+        with perfstats.phase("listdir"):
+            self._build(os.listdir(self.dir))
+    
+    def copy(self):
+        """Copies the snapshot without relisting the directory.
+        
+        :return: The copy.
+        :rtype: :class:`DirSnapshot`
+        """
+        snap = DirSnapshot.__new__(DirSnapshot)
+        snap.dir = self.dir
+        snap._build(self.files)
+        return snap
+    
+    def _build(self, files):
+        self.files = []
+        self.by_ext = {}
+        self.basenames = {}
+        
+        for fn in files:
+            root, ext = os.path.splitext(fn)
+            self.files.append(fn)
+            self.by_ext.setdefault(ext, []).append(fn)
+            self.basenames[fn] = root
+    
+    def get_files(self, exts):
+        """Gets the filenames with any of the specified file extensions, in 
+        directory listing order.
+        
+        :param exts: The file extensions to look for.
+        :return: The found files.
+        :rtype: string list
+        """
+        found = set()
+        for ext in exts:
+            found.update(self.by_ext.get(ext, []))
+        return [fn for fn in self.files if fn in found]
+    
+    def path(self, fn):
+        """Gets the full path of a file in the directory.
+        
+        :param fn: The filename.
+        :return: The path of the file.
+        :rtype: string
+        """
+        return os.path.join(self.dir, fn)
+    
+    def renamed(self, old_names, new_names):
+        """Registers that files in the directory have been renamed, keeping 
+        the listing order, without relisting the directory.
+        
+        :param old_names: The previous names of the renamed files.
+        :param new_names: The new names of the renamed files.
+        """
+        mapping = dict(zip(old_names, new_names))
+        self._build([mapping.get(fn, fn) for fn in self.files])
 
 
-def get_vid_files(dir):
+def get_vid_files(snap):
     """Gets the filenames of all video files in the specified directory, 
     that are of the supported formats.
     
-    :param dir: The directory in which to look for video files.
+    :param snap: The :class:`DirSnapshot` of the directory in which to look 
+        for video files.
     :return: The found video files.
     :rtype: string list
     """
-    return [fn for fn in os.listdir(dir) \
-            if os.path.splitext(fn)[1] in SUPP_VID_EXTS]
+    return snap.get_files(SUPP_VID_EXTS)
 
 
-def get_sub_files(dir):
+def get_sub_files(snap):
     """Gets the filenames of all subtitle files in the specified directory, 
     that are of the supported formats.
     
-    :param dir: The directory in which to look for subtitle files.
+    :param snap: The :class:`DirSnapshot` of the directory in which to look 
+        for subtitle files.
     :return: The found subtitle files.
     :rtype: string list
     """
-    return [fn for fn in os.listdir(dir) \
-            if os.path.splitext(fn)[1] in SUPP_SUB_EXTS]
+    return snap.get_files(SUPP_SUB_EXTS)
+
+
+def calc_vid_hash(path):
+    """Computes the hash of a video file, defined as the file size plus the 
+    sums of the 64-bit little-endian words of the first and last 64 KiB of the 
+    file, truncated to 64 bits. This is the hash used by subtitle databases 
+    to identify videos. The file is memory-mapped, so only the head and tail 
+    of the file are read regardless of its size.
+    
+    :param path: The path of the video file.
+    :return: The hash as a 16-digit hexadecimal string.
+    :rtype: string
+    """
+    size = os.path.getsize(path)
+    chunks = []
+    
+    if size > 0:
+        with perfstats.phase("hash"), open(path, "rb") as fr, \
+                mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            chunks.append(mm[:HASH_CHUNK_SIZE])
+            chunks.append(mm[max(size - HASH_CHUNK_SIZE, 0):])
+    
+    vid_hash = size
+    for chunk in chunks:
+        chunk += b"\0" * (-len(chunk) % 8)
+        vid_hash += sum(struct.unpack("<{}Q".format(len(chunk) // 8), chunk))
+    
+    return "{:016x}".format(vid_hash & 0xFFFFFFFFFFFFFFFF)
+
+
+def get_vid_hash(path, cache):
+    """Gets the hash of a video file from the cache, computing it using 
+    :func:`calc_vid_hash` if the file isn't cached or has changed since it 
+    was cached, based on its size and modification time.
+    
+    :param path: The path of the video file.
+    :param cache: The cache, as loaded from :data:`HASH_CACHE_FN`. It's 
+        updated with the hash if it's computed.
+    :return: The hash of the video file.
+    :rtype: string
+    """
+    key = os.path.abspath(path)
+    stat = os.stat(key)
+    entry = cache.get(key)
+    
+    if entry is None or entry["size"] != stat.st_size \
+            or entry["mtime"] != stat.st_mtime_ns:
+        entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, 
+                 "hash": calc_vid_hash(key)}
+        cache[key] = entry
+    
+    return entry["hash"]
+
+
+def pair_subs_by_hash(snap, cache):
+    """Pairs the subtitle files in a directory with video files, using the 
+    video file hashes recorded for the subtitle files in the directory's 
+    :data:`SUB_HASHES_FN` sidecar file. Every video file is paired with at 
+    most one subtitle file per language suffix, as in 
+    :func:`pair_subs_by_tokens`, and the further subtitle files with the same 
+    hash and language suffix are left unpaired.
+    
+    :param snap: The :class:`DirSnapshot` of the directory in which to look 
+        for subtitle and video files.
+    :param cache: The cache of video file hashes, loaded from 
+        :data:`HASH_CACHE_FN`.
+    :return: The paired subtitle and video files, as (subtitle file, video 
+        file) tuples, and the subtitle files left unpaired since their video 
+        file was already paired with a subtitle file in their language. Both 
+        are empty if the directory has no sidecar file.
+    :raises ValueError: Raised if the sidecar file is malformed.
+    :rtype: ((string, string) tuple list, string list) tuple
+    """
+    if SUB_HASHES_FN not in snap.basenames:
+        return [], []
+    
+    try:
+        with open(snap.path(SUB_HASHES_FN), "r", encoding="utf-8") as fr:
+            sub_hashes = json.load(fr)
+    except ValueError:
+        sub_hashes = None
+    
+    if not isinstance(sub_hashes, dict):
+        raise ValueError("Ignoring malformed '{}'.".format(SUB_HASHES_FN))
+    
+    subs = sorted(fn for fn in get_sub_files(snap) if fn in sub_hashes)
+    
+    if len(subs) == 0:
+        return [], []
+    
+    vids = {}
+    for fn in get_vid_files(snap):
+        vids.setdefault(get_vid_hash(snap.path(fn), cache), fn)
+    
+    pairs, extras, taken = [], [], set()
+    
+    for fn in subs:
+        vid = vids.get(sub_hashes[fn])
+        if vid is None:
+            continue
+        key = vid, split_lang(snap.basenames[fn])[1]
+        if key in taken:
+            extras.append(fn)
+        else:
+            taken.add(key)
+            pairs.append((fn, vid))
+    
+    return pairs, extras
+
+
+def split_lang(root):
+    """Splits the language suffix, if any, from a subtitle file basename, 
+    see :data:`LANG_PATTERN`.
+    
+    :param root: The basename of the subtitle file.
+    :return: The basename without the language suffix, and the language 
+        suffix, which is empty if there is none.
+    :rtype: (string, string) tuple
+    """
+    match = LANG_PATTERN.search(root)
+    if match is None or match.group(1) not in LANG_CODES:
+        return root, ""
+    return root[:match.start()], root[match.start():]
+
+
+def pair_subs_by_tokens(sub_files, vid_files):
+    """Pairs subtitle files with video files by the similarity of their 
+    names, regardless of their order. The basenames of the video files are 
+    tokenized into an inverted index, which gives each subtitle file a few 
+    candidate video files sharing uncommon tokens or episode numbers with 
+    it. The score of a candidate is 1 if their episode numbers match, plus 
+    the overlap of their tokens weighted by inverse document frequency, 
+    between 0 and 1, so that tokens shared by every file don't count. Files 
+    whose episode numbers differ are never paired. 
+    
+    The pairs are then assigned globally, from the highest scoring pair 
+    down, so that a file is never taken by a worse match just because it 
+    was listed first. Every video file is paired with at most one subtitle 
+    file per language suffix, which is kept in the new name, so that 
+    subtitles in several languages can be paired with the same video file.
+    
+    :param sub_files: The subtitle files.
+    :param vid_files: The video files.
+    :return: The paired subtitle files and new names, as (subtitle file, 
+        name) tuples, and the set of paired video files. The names are the 
+        basenames of the video files with the language suffixes of the 
+        subtitle files.
+    :rtype: ((string, string) tuple list, string set) tuple
+    """
+    vid_roots = get_file_basenames(vid_files)
+    vid_tokens = [set(TOKEN_PATTERN.findall(vr.lower())) for vr in vid_roots]
+    vid_keys = [set(parse_ep_keys(fn) or []) for fn in vid_files]
+    index, ep_index = {}, {}
+    
+    for idx, (tokens, keys) in enumerate(zip(vid_tokens, vid_keys)):
+        for token in tokens:
+            index.setdefault(token, []).append(idx)
+        for key in keys:
+            ep_index.setdefault(key, []).append(idx)
+    
+    idf = {token: math.log((len(vid_files) + 1) / len(idxs)) \
+           for token, idxs in index.items()}
+    edges = []
+    
+    for sub_idx, fn in enumerate(sub_files):
+        root, lang = split_lang(os.path.splitext(fn)[0])
+        tokens = set(TOKEN_PATTERN.findall(root.lower()))
+        keys = set(parse_ep_keys(fn) or [])
+        sub_weight = sum(idf.get(token, 0.0) for token in tokens)
+        
+        cands = set()
+        for key in keys:
+            cands.update(ep_index.get(key, []))
+        for token in tokens:
+            if len(index.get(token, [])) <= MAX_CANDIDATE_DF:
+                cands.update(index.get(token, []))
+        
+        scored = []
+        
+        for vid_idx in cands:
+            if keys and vid_keys[vid_idx] and not keys & vid_keys[vid_idx]:
+                continue
+            shared = sum(idf[token] for token in tokens & vid_tokens[vid_idx])
+            union = sub_weight + sum(idf[token] for token in \
+                                     vid_tokens[vid_idx]) - shared
+            score = (1.0 if keys & vid_keys[vid_idx] else 0.0) \
+                    + (shared / union if union > 0 else 0.0)
+            if score >= MIN_PAIR_SCORE:
+                scored.append((-score, vid_idx))
+        
+        for neg_score, vid_idx in sorted(scored)[:MAX_CANDIDATES]:
+            edges.append((neg_score, sub_idx, vid_idx, lang))
+    
+    pairs, paired_subs, taken = [], set(), set()
+    
+    for _, sub_idx, vid_idx, lang in sorted(edges):
+        if sub_idx in paired_subs or (vid_idx, lang) in taken:
+            continue
+        paired_subs.add(sub_idx)
+        taken.add((vid_idx, lang))
+        pairs.append((sub_idx, vid_roots[vid_idx] + lang))
+    
+    pairs.sort()
+    paired_vids = set(vid_files[vid_idx] for vid_idx, _ in taken)
+    return [(sub_files[idx], name) for idx, name in pairs], paired_vids
 
 
 def get_file_basenames(files):
@@ -392,13 +1065,30 @@ def assign_exts(roots, exts):
     return [r+e for r, e in zip(roots, exts)]
 
 
-def confirm_rename(old_names, new_names):
+def confirm(question, plan=None):
+    """Prompts the user with a yes/no question. No prompt is made when 
+    planning, since the plan is reviewed before being applied, in which case 
+    the answer is always yes.
+    
+    :param question: The question to prompt the user with.
+    :param plan: The plan, or None if not planning.
+    :return: True if the user answers yes, False otherwise.
+    :rtype: bool
+    """
+    if plan is not None:
+        print(question + "y")
+        return True
+    return input(question).lower() == "y"
+
+
+def confirm_rename(old_names, new_names, plan=None):
     """Prompts the user to confirm whether to perform the operation of 
     renaming a list of old filenames to a list of new filenames.
     
     :param old_names: The current names of the files to rename.
     :param new_names: The list of new names which will be used to rename the 
         files specified by the `old_names` parameter.
+    :param plan: The plan, or None if not planning.
     :return: True if the user confirms the renaming operatin, False otherwise.
     :rtype: bool
     """
@@ -407,7 +1097,7 @@ def confirm_rename(old_names, new_names):
     for on, nn in zip(old_names, new_names):
         print("{} --> {}".format(on, nn))
     
-    return input("\nContinue? [y/N] ").lower() == "y"
+    return confirm("\nContinue? [y/N] ", plan)
 
 
 def print_files_names(files, names):
@@ -427,62 +1117,490 @@ def print_files_names(files, names):
     print()
 
 
-def rename_files(get_files_method, new_names, dir):
-    """Gets a list of filenames using the `get_files_method` and `dir` 
+def rename_files(get_files_method, new_names, snap, plan=None):
+    """Gets a list of filenames using the `get_files_method` and `snap` 
     parameters and renames those files using the list of names specified by 
-    the `new_names` parameter.
+    the `new_names` parameter, pairing files and names by position. When 
+    planning, the renames are marked as positional in the plan, and the 
+    redundant files are recorded as unmatched.
     
     :param get_files_method: The method used to fetch the list of filenames 
         that are to be renamed. This method should accept a single parameter 
-        specifying the directory in which to look for files, and return a list 
-        of filenames.
+        specifying the :class:`DirSnapshot` in which to look for files, and 
+        return a list of filenames.
     :param new_names: The list of names used to rename the files fetched by 
         the method specified by the `get_files_method` parameter.
-    :param dir: The directory in which to look for files when using the 
-        get_files_method.
+    :param snap: The :class:`DirSnapshot` of the directory in which to look 
+        for files when using the get_files_method. It's updated with the 
+        performed renames.
+    :param plan: The plan to add the renames to instead of performing them, 
+        see :func:`new_plan`, or None to perform them.
+    :return: False if the renames can't be performed, True otherwise.
+    :rtype: bool
     """
-    old_names = get_files_method(dir)
+    old_names = get_files_method(snap)
     
     if len(old_names) == 0:
         print("No files found.")
-        return
+        return True
     
     if len(old_names) > len(new_names):
         print("Warning: More files than names were found.")
         print_files_names(old_names, new_names)
-        if input("Ignore redundant files and continue? [y/N] ").lower() != "y":
-            return
+        if not confirm("Ignore redundant files and continue? [y/N] ", plan):
+            return True
+        if plan is not None:
+            add_unmatched_to_plan(plan, snap, old_names[len(new_names):])
         old_names = old_names[:len(new_names)]
     
     if len(old_names) < len(new_names):
         print("Warning: More names than files were found.")
         print_files_names(old_names, new_names)
-        if input("Ignore redundant names and continue? [y/N] ").lower() != "y":
-            return
+        if not confirm("Ignore redundant names and continue? [y/N] ", plan):
+            return True
         #new_names = new_names[:len(old_names)]
         del new_names[len(old_names):]
     
+    return apply_renames(old_names, new_names, snap, plan, positional=True)
+
+
+def pair_files_by_ep(files, name_keys, names, paired=None):
+    """Pairs files with new names by their episode keys using 
+    :func:`match_files_names`, after leaving out the files that have already 
+    been paired by other means.
+    
+    :param files: The filenames to pair with names.
+    :param name_keys: The list of episode keys of each name.
+    :param names: The list of new names.
+    :param paired: The list of files already paired with new names by other 
+        means, as (file, name) tuples. The names should not be included in 
+        the `names` parameter.
+    :return: The list of all paired files and names, as (file, name) tuples, 
+        and the list of files that couldn't be paired with any name.
+    :rtype: ((string, string) tuple list, string list) tuple
+    """
+    paired = paired or []
+    paired_files = set(fn for fn, _ in paired)
+    files = [fn for fn in files if fn not in paired_files]
+    pairs, unmatched = match_files_names(files, name_keys, names)
+    return paired + pairs, unmatched
+
+
+def rename_files_by_ep(get_files_method, name_keys, new_names, snap, 
+                       plan=None, paired=None):
+    """Gets a list of filenames using the `get_files_method` and `snap` 
+    parameters and renames those files using the list of names specified by 
+    the `new_names` parameter, pairing files and names by their episode keys 
+    using :func:`match_files_names`. Falls back to pairing by position using 
+    :func:`rename_files` if no file contains episode numbers matching any 
+    name. When planning, the unmatched files are recorded in the plan.
+    
+    :param get_files_method: The method used to fetch the list of filenames 
+        that are to be renamed, see :func:`rename_files`.
+    :param name_keys: The list of episode keys of each name.
+    :param new_names: The list of names used to rename the files fetched by 
+        the method specified by the `get_files_method` parameter.
+    :param snap: The :class:`DirSnapshot` of the directory in which to look 
+        for files when using the get_files_method. It's updated with the 
+        performed renames.
+    :param plan: The plan to add the renames to instead of performing them, 
+        see :func:`new_plan`, or None to perform them.
+    :param paired: The list of files already paired with new names by other 
+        means, as (file, name) tuples. The names should not be included in 
+        the `new_names` parameter.
+    :return: False if the renames can't be performed, True otherwise.
+    :rtype: bool
+    """
+    old_names = get_files_method(snap)
+    
+    if len(old_names) == 0:
+        print("No files found.")
+        return True
+    
+    pairs, unmatched = pair_files_by_ep(old_names, name_keys, new_names, 
+                                        paired)
+    
+    if len(pairs) == 0:
+        print("Warning: No files could be matched to names by episode "
+              "number, matching by position instead.")
+        return rename_files(get_files_method, new_names, snap, plan)
+    
+    if len(unmatched) > 0:
+        print("Warning: The following files couldn't be matched to any name "
+              "by episode number:\n")
+        for fn in unmatched:
+            print(fn)
+        if not confirm("\nIgnore unmatched files and continue? [y/N] ", plan):
+            return True
+        if plan is not None:
+            add_unmatched_to_plan(plan, snap, unmatched)
+    
+    return apply_renames([on for on, _ in pairs], [nn for _, nn in pairs], 
+                         snap, plan)
+
+
+def apply_renames(old_names, new_names, snap, plan=None, positional=False):
+    """Renames files after assigning the file extensions of the old names to 
+    the new names, and prompting the user for confirmation.
+    
+    :param old_names: The current names of the files to rename.
+    :param new_names: The list of new names, without file extensions.
+    :param snap: The :class:`DirSnapshot` of the directory containing the 
+        files. It's updated with the performed (or planned) renames, so that 
+        later stages see the files under their new names.
+    :param plan: The plan to add the renames to instead of performing them, 
+        see :func:`new_plan`, or None to perform them.
+    :param positional: Denoting that the files were paired with the new names 
+        by position, which is recorded in the plan.
+    :return: False if the renames can't be performed, True otherwise, 
+        including if the user declines them.
+    :rtype: bool
+    """
     new_names = assign_exts(new_names, get_file_exts(old_names))
     
-    if not confirm_rename(old_names, new_names):
-        return
+    try:
+        check_names(snap, old_names, new_names)
+    except ValueError as e:
+        print("\nError: {}".format(e))
+        return False
     
-    old_names = [os.path.join(dir, on) for on in old_names]
-    new_names = [os.path.join(dir, nn) for nn in new_names]
+    with perfstats.phase("confirm"):
+        if not confirm_rename(old_names, new_names, plan):
+            return True
     
+    if plan is not None:
+        add_to_plan(plan["renames"], snap, old_names, new_names, positional)
+    else:
+        renames = [(snap.path(on), snap.path(nn)) \
+                   for on, nn in zip(old_names, new_names) if on != nn]
+        temp_journaled_rename(renames, "renamer")
+    
+    snap.renamed(old_names, new_names)
+    return True
+
+
+def new_plan():
+    """Creates an empty plan, which holds the list of planned renames, and the 
+    list of paths of the files left out of the plan since they couldn't be 
+    paired with a new name. Renames of files paired with new names by 
+    position rather than by episode number are marked as positional, so that 
+    they can be reviewed before the plan is applied.
+    
+    :return: The plan, in the format of the plan files.
+    :rtype: dict
+    """
+    return {"renames": [], "unmatched": []}
+
+
+def add_to_plan(plan, snap, old_names, new_names, positional=False):
+    """Adds renames to a list of planned renames, leaving out files whose 
+    names are unchanged.
+    
+    :param plan: The list of planned renames.
+    :param snap: The :class:`DirSnapshot` of the directory containing the 
+        files.
+    :param old_names: The current names of the files to rename.
+    :param new_names: The new names of the files, with file extensions.
+    :param positional: Denoting that the files were paired with the new names 
+        by position.
+    """
     for on, nn in zip(old_names, new_names):
-        os.rename(on, nn)
+        if on != nn:
+            rename = {"dir": os.path.abspath(snap.dir), "old": on, "new": nn}
+            if positional:
+                rename["positional"] = True
+            plan.append(rename)
+
+
+def add_unmatched_to_plan(plan, snap, files):
+    """Records files that couldn't be paired with a new name in a plan.
+    
+    :param plan: The plan, see :func:`new_plan`.
+    :param snap: The :class:`DirSnapshot` of the directory containing the 
+        files.
+    :param files: The names of the files.
+    """
+    plan["unmatched"].extend(os.path.join(os.path.abspath(snap.dir), fn) \
+                             for fn in files)
+
+
+def write_plan(plan_fn, plan):
+    """Writes a plan to a JSON plan file, to be applied later using 
+    :func:`apply_plan`.
+    
+    :param plan_fn: The filename of the plan file.
+    :param plan: The plan, see :func:`new_plan`.
+    """
+    with open(plan_fn, "w", encoding="utf-8") as fw:
+        json.dump(plan, fw, indent=2, ensure_ascii=False)
+
+
+def read_plan(plan_fn):
+    """Reads the renames of a JSON plan file written by :func:`write_plan`.
+    
+    :param plan_fn: The filename of the plan file.
+    :return: The list of renames, as (old path, new path) tuples.
+    :rtype: (string, string) tuple list
+    """
+    with open(plan_fn, "r", encoding="utf-8") as fr:
+        plan = json.load(fr)
+    
+    return plan_paths(plan["renames"])
+
+
+def plan_paths(plan):
+    """Converts a list of planned renames to the old and new paths of the 
+    renamed files.
+    
+    :param plan: The list of planned renames.
+    :return: The list of renames, as (old path, new path) tuples.
+    :rtype: (string, string) tuple list
+    """
+    return [(os.path.join(r["dir"], r["old"]), 
+             os.path.join(r["dir"], r["new"])) for r in plan]
+
+
+def check_path_length(path):
+    """Checks that a path isn't longer than :data:`MAX_PATH` allows.
+    
+    :param path: The path.
+    :raises ValueError: Raised if the path is too long.
+    """
+    if len(os.path.abspath(path)) >= MAX_PATH:
+        raise ValueError("'{}' is longer than the maximum path length of {} "
+                         "characters.".format(path, MAX_PATH - 1))
+
+
+def check_names(snap, old_names, new_names):
+    """Checks that files in a directory can be renamed to a list of new 
+    names, before any of them is renamed. Names are compared regardless of 
+    case, as on Windows.
+    
+    :param snap: The :class:`DirSnapshot` of the directory containing the 
+        files.
+    :param old_names: The current names of the files to rename.
+    :param new_names: The new names of the files, with file extensions.
+    :raises ValueError: Raised if two files are renamed to the same name, if 
+        a file not being renamed already has a new name, or if a new path is 
+        too long, see :func:`check_path_length`.
+    """
+    existing = set(fn.lower() for fn in snap.files) \
+               - set(on.lower() for on in old_names)
+    seen = set()
+    
+    for nn in new_names:
+        key = nn.lower()
+        if key in seen:
+            raise ValueError("More than one file renamed to '{}'.".format(nn))
+        if key in existing:
+            raise ValueError("'{}' already exists.".format(nn))
+        check_path_length(snap.path(nn))
+        seen.add(key)
+
+
+def check_renames(renames):
+    """Checks that a list of renames can be performed without overwriting any 
+    files. Renames may swap names or form cycles, since they are performed in 
+    two phases by :func:`journaled_rename`.
+    
+    :param renames: The list of renames, as (old path, new path) tuples.
+    :raises ValueError: Raised if a file to rename doesn't exist, if two files 
+        are renamed to the same name, if a file would be overwritten, or if a 
+        new path is too long, see :func:`check_path_length`.
+    """
+    olds = set(os.path.normcase(os.path.abspath(on)) for on, _ in renames)
+    news = set()
+    
+    for on, nn in renames:
+        key = os.path.normcase(os.path.abspath(nn))
+        
+        if not os.path.exists(on):
+            raise ValueError("'{}' doesn't exist.".format(on))
+        if key in news:
+            raise ValueError("More than one file renamed to '{}'.".format(nn))
+        if os.path.exists(nn) and key not in olds:
+            raise ValueError("'{}' already exists.".format(nn))
+        check_path_length(nn)
+        
+        news.add(key)
+
+
+def write_journal_entry(fw, entry):
+    """Appends an entry to a journal and flushes it to disk, so that the 
+    journal reflects the performed renames even if the process crashes.
+    
+    :param fw: The journal file, opened for appending.
+    :param entry: The JSON serialisable entry.
+    """
+    fw.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    fw.flush()
+    os.fsync(fw.fileno())
 
 
-def rename_vid_files(dir, link, 
-                     s_name=None, s_num=None, sngl=False, e_idxs=None):
-    """Renames all video files in the directory specified by the `dir` 
+def read_journal(journal_fn):
+    """Reads a journal written by :func:`journaled_rename`.
+    
+    :param journal_fn: The filename of the journal.
+    :raises ValueError: Raised if the journal is corrupt.
+    :return: The journaled renames, as lists of old, temporary and new paths, 
+        the set of (phase, index) tuples of the completed steps, and whether 
+        all renames were completed.
+    :rtype: (string list list, (int, int) tuple set, bool) tuple
+    """
+    with open(journal_fn, "r", encoding="utf-8") as fr:
+        lines = fr.read().split("\n")
+    
+    # A crash while writing an entry leaves it truncated at the end of the 
+    # journal, meaning the step wasn't journaled.
+    entries = []
+    for idx, line in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            if idx == len(lines) - 1 and idx > 0:
+                break
+            raise ValueError("Journal '{}' is corrupt.".format(journal_fn))
+    
+    try:
+        renames = entries[0]["renames"]
+        steps = set((e["phase"], e["idx"]) for e in entries[1:] \
+                    if "phase" in e)
+        done = any(e.get("done") for e in entries[1:])
+    except (IndexError, KeyError, TypeError):
+        raise ValueError("Journal '{}' is corrupt.".format(journal_fn))
+    
+    return renames, steps, done
+
+
+def journaled_rename(renames, journal_fn):
+    """Performs a list of renames in two phases, first renaming all files to 
+    temporary names and then to their new names, which allows names to be 
+    swapped between files. Every step is recorded in a journal, which is used 
+    to resume the renames if interrupted, and to undo them using 
+    :func:`undo_journal`. If the journal already exists, the renames recorded 
+    in it are resumed instead of starting the specified ones.
+    
+    :param renames: The list of renames, as (old path, new path) tuples.
+    :param journal_fn: The filename of the journal.
+    """
+    if os.path.exists(journal_fn):
+        entries, steps, done = read_journal(journal_fn)
+        if done:
+            return
+    else:
+        token = uuid.uuid4().hex[:8]
+        entries = [[on, 
+                    os.path.join(os.path.dirname(on), 
+                                 ".renamer-{}-{}.tmp".format(token, idx)), 
+                    nn] for idx, (on, nn) in enumerate(renames)]
+        steps = set()
+        with open(journal_fn, "w", encoding="utf-8") as fw:
+            write_journal_entry(fw, {"renames": entries})
+    
+    with perfstats.phase("rename"), \
+            open(journal_fn, "a", encoding="utf-8") as fw:
+        for phase, src, dst in [(1, 0, 1), (2, 1, 2)]:
+            for idx, entry in enumerate(entries):
+                if (phase, idx) in steps:
+                    continue
+                # A crash between renaming and journaling leaves the file 
+                # at its destination without a journal entry.
+                if os.path.exists(entry[src]) \
+                        or not os.path.exists(entry[dst]):
+                    os.rename(entry[src], entry[dst])
+                write_journal_entry(fw, {"phase": phase, "idx": idx})
+        
+        write_journal_entry(fw, {"done": True})
+
+
+def temp_journaled_rename(renames, prefix):
+    """Performs a list of renames using :func:`journaled_rename`, so that 
+    names may be swapped between files, journaling them to a new file in the 
+    temporary directory. The journal is removed once all renames are 
+    performed, and otherwise kept so that they can be undone.
+    
+    :param renames: The list of renames, as (old path, new path) tuples.
+    :param prefix: The prefix of the journal's filename.
+    :raises OSError: Raised if a rename fails, after printing the filename of 
+        the kept journal.
+    """
+    journal_fn = os.path.join(tempfile.gettempdir(), "{}-{}{}".format(
+        prefix, uuid.uuid4().hex, JOURNAL_EXT))
+    
+    try:
+        journaled_rename(renames, journal_fn)
+    except OSError:
+        if os.path.exists(journal_fn):
+            print("\nUndo with: renamer --undo {}".format(journal_fn))
+        raise
+    
+    os.remove(journal_fn)
+
+
+def apply_plan(plan_fn):
+    """Applies the renames of a plan file written by :func:`write_plan`, 
+    journaling them to a file named as the plan file with 
+    :data:`JOURNAL_EXT` appended. An interrupted apply is resumed by applying 
+    the same plan again.
+    
+    :param plan_fn: The filename of the plan file.
+    :raises ValueError: Raised if the plan has already been applied, or can't 
+        be applied without overwriting files.
+    """
+    journal_fn = plan_fn + JOURNAL_EXT
+    
+    if os.path.exists(journal_fn):
+        if read_journal(journal_fn)[2]:
+            raise ValueError("Plan has already been applied.")
+        renames = None
+    else:
+        renames = read_plan(plan_fn)
+        check_renames(renames)
+    
+    journaled_rename(renames, journal_fn)
+
+
+def undo_journal(journal_fn):
+    """Undoes the renames recorded in a journal, completed or not, renaming 
+    all files back to their old names. The undo is itself journaled, to a 
+    file named as the journal with :data:`UNDO_EXT` appended, and is resumed 
+    if interrupted by undoing again.
+    
+    :param journal_fn: The filename of the journal.
+    :raises ValueError: Raised if the renames can't be undone without 
+        overwriting files.
+    """
+    undo_fn = journal_fn + UNDO_EXT
+    
+    if os.path.exists(undo_fn):
+        journaled_rename(None, undo_fn)
+        return
+    
+    entries, steps, _ = read_journal(journal_fn)
+    renames = []
+    
+    for idx, (on, tmp, nn) in enumerate(entries):
+        if (2, idx) in steps or os.path.exists(nn) and not os.path.exists(tmp):
+            renames.append((nn, on))
+        elif (1, idx) in steps or os.path.exists(tmp):
+            renames.append((tmp, on))
+    
+    check_renames(renames)
+    journaled_rename(renames, undo_fn)
+
+
+def rename_vid_files(snap, link, s_name=None, s_num=None, sngl=False, 
+                     e_idxs=None, plan=None, template=NAME_TEMPLATE):
+    """Renames all video files in the directory specified by the `snap` 
     parameter, that are of the supported formats, using the new names scraped 
     from the web page defined by the `link` parameter. If the `e_idxs` 
     parameter is provided, only the episode names defined by the indices in 
     that list will be used when renaming.
     
-    :param dir: The directory in which to look for video files.
+    :param snap: The :class:`DirSnapshot` of the directory in which to look 
+        for video files.
     :param link: The link to the web page which to scrape for new names.
     :param s_name: The show name (optional, an attempt to scrape it will be 
         made if not specified).
@@ -492,66 +1610,164 @@ def rename_vid_files(dir, link,
         the Wikipedia page has a different structure then).
     :param e_idxs: The indices of the selected episode names that should be 
         used when renaming.
+    :param plan: The plan to add the renames to instead of performing them, 
+        see :func:`new_plan`, or None to perform them.
+    :param template: The template of the new names, see 
+        :func:`compile_template`.
+    :return: False if the files can't be renamed, True otherwise.
+    :rtype: bool
     """
     print("\n--- RENAMING VIDEO FILES ---")
     
     if link is None:
-        link, s_name, s_num = try_guess_link(dir, s_name, s_num, sngl)
+        link, s_name, s_num = try_guess_link(snap, s_name, s_num, sngl)
     
         if link is None:
             print("\nError: Failed to guess link to show. "
                   "Please specify '--link' parameter.")
-            return
+            return False
     
     show_info = try_get_show_info(link, s_name, s_num, sngl)
     
     if show_info is None:
         print("\nError: Failed to get show information from link.")
-        return
+        return False
     
-    s_name, s_num, e_nums, e_names = show_info
-    e_names_san = [sanitise_fn(en) for en in e_names]
-    
-    if "" in e_names_san:
+    try:
+        ep_keys, new_vid_fns = gen_vid_names(*show_info, e_idxs=e_idxs, 
+                                             template=template)
+    except AssertionError:
         print("\nError: Empty episode name after filename sanitiation.")
-        return
+        return False
     
-    new_vid_fns = gen_vid_filenames(s_name, s_num, e_nums, e_names_san)
+    return rename_files_by_ep(get_vid_files, ep_keys, new_vid_fns, snap, 
+                              plan)
+
+
+def gen_vid_names(s_name, s_num, e_nums, e_names, e_idxs=None, 
+                  template=NAME_TEMPLATE):
+    """Generates the new names of video files, along with their episode keys, 
+    from the information about a show's season as returned by 
+    :func:`get_show_info`.
     
+    :param s_name: The name of the show.
+    :param s_num: The number of the season.
+    :param e_nums: The list of numbers of all episodes. Each number is a list 
+        itself, to take into account the possibility of double episodes.
+    :param e_names: The list of names of all episodes.
+    :param e_idxs: The indices of the selected episodes (optional, all 
+        episodes are selected if not specified). Only the names of the 
+        selected episodes are generated.
+    :param template: The template of the names, see 
+        :func:`compile_template`.
+    :raises AssertionError: Raised if an episode name is empty after being 
+        sanitised.
+    :return: The list of episode keys of each name, see :func:`gen_ep_keys`, 
+        and the list of new names, without file extensions.
+    :rtype: ((int, int) tuple list list, string list) tuple
+    """
     if e_idxs is not None:
-        new_vid_fns = [new_vid_fns[idx] for idx in e_idxs \
-                       if idx in range(len(new_vid_fns))]
+        e_idxs = [idx for idx in e_idxs if idx in range(len(e_names))]
+        e_nums = [e_nums[idx] for idx in e_idxs]
+        e_names = [e_names[idx] for idx in e_idxs]
+    
+    e_names_san = [sanitise_fn(en) for en in e_names]
+    assert "" not in e_names_san
     
-    rename_files(get_vid_files, new_vid_fns, dir)
+    new_vid_fns = gen_vid_filenames(s_name, s_num, e_nums, e_names_san, 
+                                    template)
+    return gen_ep_keys(s_num, e_nums), new_vid_fns
 
 
-def rename_sub_files(dir):
-    """Renames all subtitle files in the directory specified by the `dir` 
+def rename_sub_files(snap, plan=None):
+    """Renames all subtitle files in the directory specified by the `snap` 
     parameter, that are of the supported formats, using the video files found 
-    in the same directory.
-    
-    :param dir: The directory in which to look for subtitle and video files.
+    in the same directory. Subtitle files are paired with video files by the 
+    video file hashes in the directory's :data:`SUB_HASHES_FN` sidecar file 
+    if present, and otherwise by episode number.
+    
+    :param snap: The :class:`DirSnapshot` of the directory in which to look 
+        for subtitle and video files.
+    :param plan: The plan to add the renames to instead of performing them, 
+        see :func:`new_plan`, or None to perform them.
+    :return: False if the files can't be renamed, True otherwise.
+    :rtype: bool
     """
     print("\n--- RENAMING SUBTITLE FILES ---")
     
-    vid_files = get_vid_files(dir)
-    new_sub_fns = get_file_basenames(vid_files)
-    rename_files(get_sub_files, new_sub_fns, dir)
+    paired, ep_keys, new_sub_fns = gen_sub_names(snap)
+    return rename_files_by_ep(get_sub_files, ep_keys, new_sub_fns, snap, 
+                              plan, paired)
+
+
+def gen_sub_names(snap, warnings=None):
+    """Generates the new names of subtitle files from the video files in the 
+    same directory. Subtitle files that can be paired with video files by 
+    hash using :func:`pair_subs_by_hash`, or else by name using 
+    :func:`pair_subs_by_tokens`, are paired directly, keeping their language 
+    suffixes. The names of the remaining video files are returned along with 
+    their episode keys. Subtitle files left unpaired by hash since their 
+    video file was already paired aren't paired by name, and so end up 
+    unmatched. A malformed :data:`SUB_HASHES_FN` sidecar file is ignored with 
+    a warning.
+    
+    :param snap: The :class:`DirSnapshot` of the directory in which to look 
+        for subtitle and video files.
+    :param warnings: The list to add warnings to, or None to print them.
+    :return: The subtitle files paired with new names, as (file, name) 
+        tuples, the list of episode keys of each remaining name, and the 
+        list of remaining names, all without file extensions.
+    :rtype: ((string, string) tuple list, (int, int) tuple list list, 
+        string list) tuple
+    """
+    cache = jsoncache.load(HASH_CACHE_FN)
+    try:
+        hash_pairs, hash_extras = pair_subs_by_hash(snap, cache)
+    except ValueError as e:
+        hash_pairs, hash_extras = [], []
+        if warnings is None:
+            print("Warning: {}".format(e))
+        else:
+            warnings.append(str(e))
+    
+    if len(hash_pairs) > 0:
+        jsoncache.save(cache, HASH_CACHE_FN)
+    
+    paired_vids = set(vid for _, vid in hash_pairs)
+    paired = [(sub, snap.basenames[vid] + split_lang(snap.basenames[sub])[1]) \
+              for sub, vid in hash_pairs]
+    paired_subs = set(sub for sub, _ in hash_pairs) | set(hash_extras)
+    
+    with perfstats.phase("pair"):
+        token_pairs, token_vids = pair_subs_by_tokens(
+            [fn for fn in get_sub_files(snap) if fn not in paired_subs], 
+            [fn for fn in get_vid_files(snap) if fn not in paired_vids])
+    
+    paired += token_pairs
+    paired_vids |= token_vids
+    vid_files = [fn for fn in get_vid_files(snap) if fn not in paired_vids]
+    new_sub_fns = [snap.basenames[fn] for fn in vid_files]
+    ep_keys = [parse_ep_keys(fn) or [] for fn in vid_files]
+    
+    return paired, ep_keys, new_sub_fns
 
 
-def link_type(link):
-    """Defines the type for the input Wikipedia links parsed by argparse in 
-    the :func:`get_args` function.
+def check_link(link):
+    """Checks that the input Wikipedia link responds successfully upon 
+    request. It's checked by :func:`get_args` after the arguments are parsed 
+    rather than as their type, so that the request is profiled.
     
     :param link: The Wikipedia link entered by the user at command line.
-    :raises argparse.ArgumentTypeError: Raised if the input link doesn't 
-        respond successfully upon request.
-    :return: The same link as input, but after being verified.
-    :rtype: string
+    :return: True if the request succeeds, False otherwise.
+    :rtype: bool
     """
-    if not requests.get(link).status_code == 200:
-        raise argparse.ArgumentTypeError("Link request failed.")
-    return link
+    import requests
+    
+    try:
+        with perfstats.phase("check_link"):
+            return get_session().get(link, timeout=10).status_code == 200
+    except requests.RequestException:
+        return False
 
 
 def num_type(num):
@@ -612,11 +1828,28 @@ def rang_type(ep_ranges_str):
         raise argparse.ArgumentTypeError("Invalid ranges format.")
 
 
+def template_type(template):
+    """Defines the type for the input filename template parsed by argparse in 
+    the :func:`get_args` function.
+    
+    :param template: The template entered by the user at command line.
+    :raises argparse.ArgumentTypeError: Raised if the template is invalid, 
+        see :func:`compile_template`.
+    :return: The same template as input, but after being verified.
+    :rtype: string
+    """
+    try:
+        compile_template(template)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return template
+
+
 def get_args():
     """Uses the :mod:`argparse` module to parse the command line arguments.
     
     :return: The parsed input 'target', 'directory', 'link', 'show', 
-        'season number', 'single' flag and 'ranges' arguments.
+        'season number', 'single' flag, 'ranges' and 'format' arguments.
     :rtype: list (varied types)
     """
     prog_desc = """Rename a show's video and subtitle files to their correct 
@@ -645,20 +1878,48 @@ def get_args():
                    on the format X-Y, for example "2,5-6,10,13-17". Useful 
                    when only having a subset of a show's season's episodes and 
                    wanting to rename only those."""
+    plan_help = """Write the renames to a JSON plan file instead of performing 
+                   them, without prompting for confirmation."""
+    appl_help = """Apply the renames of a plan file written using '--plan', 
+                   without prompting for confirmation. The renames are 
+                   journaled to the plan's filename with '.journal' appended. 
+                   An interrupted apply is resumed by applying the plan again. 
+                   All other parameters are ignored."""
+    undo_help = """Undo the renames recorded in a journal written when 
+                   applying a plan. All other parameters are ignored."""
+    fmt_help  = """The template of the new video filenames, using the fields 
+                   {show}, {season}, {episode}, {extra} (the further episode 
+                   numbers of double episodes) and {name}. Default is 
+                   "{show} S{season:0>2}E{episode:0>2}{extra} - {name}"."""
     
     parser = argparse.ArgumentParser(prog="renamer", description=prog_desc)
     parser.add_argument("-t", "--target",  choices=["V", "S", "VS"], 
                         default="VS", help=tgt_help)
     parser.add_argument("-d", "--dir", default=".", help=dir_help)
-    parser.add_argument("-l", "--link", help=link_help, type=link_type)
+    parser.add_argument("-l", "--link", help=link_help)
     parser.add_argument("-s", "--show", help=show_help)
     parser.add_argument("-n", "--num", help=num_help, type=num_type)
     parser.add_argument("-i", "--single", help=sngl_help, action="store_true")
     parser.add_argument("-r", "--ranges", help=rang_help, type=rang_type)
+    parser.add_argument("-f", "--format", help=fmt_help, type=template_type, 
+                        default=NAME_TEMPLATE)
+    
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-p", "--plan", help=plan_help)
+    group.add_argument("-a", "--apply", help=appl_help)
+    group.add_argument("-u", "--undo", help=undo_help)
+    perfstats.add_arguments(parser)
     
     args = parser.parse_args()
+    perfstats.start("renamer", args.profile, args.profile_dump)
     tgt, dir, link, s_name = args.target, args.dir, args.link, args.show
     s_num, sngl, e_idxs = args.num, args.single, args.ranges
+    plan_fn, apply_fn, undo_fn = args.plan, args.apply, args.undo
+    template = args.format
+    
+    for fn in (apply_fn, undo_fn):
+        if fn is not None and not os.path.isfile(fn):
+            parser.error("'{}' is not a file.".format(fn))
     
     if not os.path.isdir(dir):
         parser.error("'{}' is not a valid directory.".format(dir))
@@ -667,18 +1928,56 @@ def get_args():
         parser.error("Parameters '--show' and '--num' are dependent of each "
                      "other. Provide either both or none of them.")
     
-    return tgt, dir, link, s_name, s_num, sngl, e_idxs
+    if link is not None and apply_fn is None and undo_fn is None \
+            and not check_link(link):
+        parser.error("argument -l/--link: Link request failed.")
+    
+    return (tgt, dir, link, s_name, s_num, sngl, e_idxs, 
+            plan_fn, apply_fn, undo_fn, template)
 
 
 def main():
-    tgt, dir, link, s_name, s_num, sngl, e_idxs = get_args()
+    (tgt, dir, link, s_name, s_num, sngl, e_idxs, 
+     plan_fn, apply_fn, undo_fn, template) = get_args()
     
-    if tgt in ["V", "VS"]:
-        rename_vid_files(dir, link, s_name, s_num, sngl, e_idxs)
+    ok = True
     
-    if tgt in ["S", "VS"]:
-        rename_sub_files(dir)
+    try:
+        if apply_fn is not None:
+            apply_plan(apply_fn)
+            return 0
+        if undo_fn is not None:
+            undo_journal(undo_fn)
+            return 0
+        
+        snap = DirSnapshot(dir)
+        plan = new_plan() if plan_fn is not None else None
+        
+        if tgt in ["V", "VS"]:
+            ok &= rename_vid_files(snap, link, s_name, s_num, sngl, e_idxs, 
+                                   plan, template)
+        
+        if tgt in ["S", "VS"]:
+            ok &= rename_sub_files(snap, plan)
+        
+        if plan is not None:
+            renames, unmatched = plan["renames"], plan["unmatched"]
+            positional = [r for r in renames if r.get("positional")]
+            
+            write_plan(plan_fn, plan)
+            print("\nWrote {} renames to plan: {}".format(len(renames), 
+                                                          plan_fn))
+            
+            if len(positional) > 0 or len(unmatched) > 0:
+                print("Warning: {} renames are paired by position and {} "
+                      "files are unmatched, review the plan before applying "
+                      "it.".format(len(positional), len(unmatched)))
+    except (ValueError, OSError) as e:
+        print("Error: {}".format(e))
+        return 1
+    
+    return 0 if ok else 1
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -9,72 +9,198 @@ source, and all of them seem to have the same delay). Can also take a growth
 factor into account, since sometimes the subtitle file is for the video with a 
 different frame rate, which might cause the subtitles' delay to grow or shrink 
 throughout the video.
+
+Several adjustments can be combined into a chain of transforms, given on the 
+command line or in a JSON config file, e.g. converting subtitles from a 
+23.976 fps release to a 25 fps one and then shifting them. The chain is 
+compiled into a single function of the original times, so every file is 
+read, adjusted and written only once, however long the chain is. The 
+supported transforms are:
+
+* ``shift=MS``: shift by MS milliseconds, positive for delay.
+* ``scale=RATIO``: multiply times by RATIO, e.g. ``1001/1000``. Computed 
+  exactly, using rational arithmetic.
+* ``fps=FROM:TO``: convert from a video with FROM fps to one with TO fps, 
+  e.g. ``fps=23.976:25``. The NTSC rates 23.976, 29.97, 47.952 and 59.94 
+  are taken as their exact values, e.g. 24000/1001. The presets 
+  ``fps=ntsc-pal``, ``fps=pal-ntsc``, ``fps=film-pal`` and ``fps=pal-film`` 
+  are shorthands for 23.976:25, 25:23.976, 24:25 and 25:24.
+* ``growth=MS:FACTOR``: shift by MS milliseconds times FACTOR to the power 
+  of the original time in milliseconds, as with the growth factor.
+* ``clamp=MIN:MAX``: limit times to between MIN and MAX milliseconds, either 
+  of which may be left out. Must come after all other transforms.
 """
 
 import argparse
 import os
 import re
-import datetime
 import math
+import json
+import sys
+from fractions import Fraction
+
+import perfstats
 
 
 SUPP_SUB_EXTS = [".srt"]
+JOURNAL_EXT = ".journal"
+TIME_PATTERN = re.compile(r'(\d{2}:\d{2}:\d{2},\d{3})')
+MAX_MS = 100 * 60 * 60 * 1000
+FPS_VALUES = {"23.976": Fraction(24000, 1001), "29.97": Fraction(30000, 1001), 
+              "47.952": Fraction(48000, 1001), "59.94": Fraction(60000, 1001)}
+FPS_PRESETS = {"ntsc-pal": "23.976:25", "pal-ntsc": "25:23.976", 
+               "film-pal": "24:25", "pal-film": "25:24"}
 
 
-def calc_ms(t):
-    h, m, s, ms = t.hour, t.minute, t.second, t.microsecond / 1000
-    return ((h * 60 + m) * 60 + s) * 1000 + ms
+def parse_fps(fps):
+    fps = FPS_VALUES.get(fps, None) or Fraction(fps)
+    if fps <= 0:
+        raise ValueError("Frame rate must be positive.")
+    return fps
 
 
-def is_delay_valid(delay, data):
-    time_str = re.search(r'(\d{2}:\d{2}:\d{2},\d{3})', data).group()
-    first_sub = datetime.datetime.strptime(time_str, "%H:%M:%S,%f")
-    return calc_ms(first_sub) + delay >= 0
+def parse_transform(step):
+    name, _, arg = step.partition("=")
+    
+    try:
+        if name == "shift":
+            return "shift", Fraction(arg)
+        if name in ("scale", "fps"):
+            if name == "scale":
+                ratio = Fraction(arg)
+            else:
+                src, dst = FPS_PRESETS.get(arg, arg).split(":")
+                ratio = parse_fps(src) / parse_fps(dst)
+            if ratio <= 0:
+                raise ValueError("Scale ratio must be positive.")
+            return "scale", ratio
+        if name == "growth":
+            delay, growth = arg.split(":")
+            if float(growth) <= 0:
+                raise ValueError("Growth factor must be positive.")
+            return "growth", float(delay), float(growth)
+        if name == "clamp":
+            lo, hi = arg.split(":")
+            return "clamp", int(lo) if lo else None, int(hi) if hi else None
+    except (ValueError, ZeroDivisionError):
+        raise ValueError("Invalid transform '{}'.".format(step))
+    
+    raise ValueError("Unknown transform '{}'.".format(step))
 
 
-"""
-def is_delay_valid(delay, data):
-    time_str = re.search(r'(\d{2}:\d{2}:\d{2},\d{3})', data).group()
-    first_sub = datetime.datetime.strptime(time_str, "%H:%M:%S,%f")
-    delayed = first_sub + datetime.timedelta(milliseconds=delay)
-    ftime, dtime = first_sub.time(), delayed.time()
-    return (delay >= 0 and dtime >= ftime) or (delay < 0 and dtime < ftime)
-"""
+def legacy_transforms(delay, growth):
+    # The delay and growth factor arguments, as a transform chain.
+    if growth == 1.0:
+        return ["shift={}".format(delay)]
+    return ["growth={}:{}".format(delay, growth)]
 
 
-def get_delayed_time(time_str, delay, growth):
-    time = datetime.datetime.strptime(time_str, "%H:%M:%S,%f")
-    delay = delay * growth**calc_ms(time)
-    delta = datetime.timedelta(milliseconds=delay)
-    return (time + delta).strftime("%H:%M:%S,%f")[:-3]
+def compile_transforms(steps):
+    # The chain is folded into a*t + b + sum(c * g**t) of the original time 
+    # t, followed by clamping. Scaling distributes over the growth terms, 
+    # which are functions of the original time.
+    a, b, terms, lo, hi = Fraction(1), Fraction(0), [], None, None
+    
+    for step in map(parse_transform, steps):
+        if step[0] != "clamp" and (lo, hi) != (None, None):
+            raise ValueError("Clamp must come after all other transforms.")
+        
+        if step[0] == "shift":
+            b += step[1]
+        elif step[0] == "scale":
+            a, b = a * step[1], b * step[1]
+            terms = [(c * float(step[1]), g) for c, g in terms]
+        elif step[0] == "growth":
+            terms.append(step[1:])
+        else:
+            if step[1] is not None:
+                lo = step[1] if lo is None else max(lo, step[1])
+            if step[2] is not None:
+                hi = step[2] if hi is None else min(hi, step[2])
+    
+    # Times are rounded half up: floor(a*t + b + 1/2), in exact integer 
+    # arithmetic if there are no growth terms.
+    den = a.denominator * b.denominator // math.gcd(a.denominator, 
+                                                    b.denominator)
+    a_num = 2 * a.numerator * (den // a.denominator)
+    b_num = 2 * b.numerator * (den // b.denominator) + den
+    den *= 2
+    
+    if terms:
+        transform = lambda t: math.floor((a_num * t + b_num) / den 
+                                         + sum(c * g**t for c, g in terms))
+    else:
+        transform = lambda t: (a_num * t + b_num) // den
+    
+    if (lo, hi) == (None, None):
+        return transform
+    
+    lo = -math.inf if lo is None else lo
+    hi = math.inf if hi is None else hi
+    return lambda t: min(max(transform(t), lo), hi)
 
 
-"""
-def get_delayed_time(time_str, delay_ref, growth):
-    print(time_str, delay_ref, growth)
-    time = datetime.datetime.strptime(time_str, "%H:%M:%S,%f")
-    delta = datetime.timedelta(milliseconds=delay_ref[0])
-    delay_ref[0] *= growth
-    return (time + delta).strftime("%H:%M:%S,%f")[:-3]
-"""
+def format_ms(t):
+    h, t = divmod(t, 60 * 60 * 1000)
+    m, t = divmod(t, 60 * 1000)
+    s, ms = divmod(t, 1000)
+    return "{:02}:{:02}:{:02},{:03}".format(h, m, s, ms)
 
 
-def sync_sub(file, delay, growth):
-    print("Syncing file: '{}'".format(file))
+def transform_time(time_str, transform):
+    h, m, s, ms = (int(x) for x in re.split("[:,]", time_str))
+    t = transform(((h * 60 + m) * 60 + s) * 1000 + ms)
     
-    with open(file, "r") as fr:
-        data = fr.read()
+    if t < 0:
+        raise ValueError("Delay over- or underflow, make sure negative delay "
+                         "magnitude isn't greater than time of first sub.")
+    if t >= MAX_MS:
+        raise ValueError("Delay overflow, times must be less than 100 "
+                         "hours.")
+    return format_ms(t)
+
+
+def transform_data(data, transform):
+    repl_fun = lambda m: transform_time(m.group(), transform)
     
-    if not is_delay_valid(delay, data):
-        print("Error: Delay over- or underflow, make sure negative delay "
-              "magnitude isn't greater than time of first sub.")
-        return
+    with perfstats.phase("sync"):
+        try:
+            return TIME_PATTERN.sub(repl_fun, data)
+        except OverflowError:
+            raise ValueError("Delay overflow, growth factor too large.")
+
+
+def sync_data(data, delay, growth):
+    transform = compile_transforms(legacy_transforms(delay, growth))
+    return transform_data(data, transform)
+
+
+def read_sub(file):
+    with perfstats.phase("read"), open(file, "r") as fr:
+        return fr.read()
+
+
+def write_sub(file, data):
+    # Write to a temporary file first, so that an interrupted sync never 
+    # leaves a half-written subtitle file behind.
+    tmp_file = file + ".tmp"
+    with perfstats.phase("write"):
+        with open(tmp_file, "w") as fw:
+            fw.write(data)
+        os.replace(tmp_file, file)
+
+
+def sync_sub(file, transform):
+    print("Syncing file: '{}'".format(file))
     
-    #delay_ref = [delay]
-    repl_fun = lambda m: get_delayed_time(m.group(), delay, growth)
+    try:
+        data = transform_data(read_sub(file), transform)
+    except ValueError as e:
+        print("Error: {}".format(e))
+        return False
     
-    with open(file, "r+") as fw:
-        fw.write(re.sub(r'(\d{2}:\d{2}:\d{2},\d{3})', repl_fun, data))
+    write_sub(file, data)
+    return True
 
 
 def get_sub_files(tgt):
@@ -82,15 +208,16 @@ def get_sub_files(tgt):
         return [tgt]
     
     if os.path.isdir(tgt):
-        return [fn for fn in os.listdir(tgt) \
+        perfstats.count("listdir")
+        return [os.path.join(tgt, fn) for fn in os.listdir(tgt) \
                 if os.path.splitext(fn)[1] in SUPP_SUB_EXTS]
     
     return None
 
 
-def confirm_sync(subs, delay, growth):
-    print("\nThe following files will be synchronised with {} ms delay and "
-          "delay growth factor {}:\n".format(delay, growth))
+def confirm_sync(subs, transforms):
+    print("\nThe following files will be synchronised with the transforms "
+          "{}:\n".format(", ".join(transforms)))
     
     for file in subs:
         print(file)
@@ -98,6 +225,78 @@ def confirm_sync(subs, delay, growth):
     return input("\nContinue? [y/N] ").lower() == "y"
 
 
+def write_plan(plan_file, subs, transforms):
+    syncs = [{"file": os.path.abspath(file), "transforms": transforms} \
+             for file in subs]
+    
+    with open(plan_file, "w", encoding="utf-8") as fw:
+        json.dump({"syncs": syncs}, fw, indent=2, ensure_ascii=False)
+
+
+def apply_plan(plan_file):
+    try:
+        with open(plan_file, "r", encoding="utf-8") as fr:
+            syncs = json.load(fr)["syncs"]
+        if not all(isinstance(sync.get("file"), str) for sync in syncs):
+            raise ValueError("Every synchronisation must have a file.")
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        print("Error: Invalid plan file: {}".format(e))
+        return False
+    
+    # Synced files are journaled, so that resuming an interrupted apply 
+    # doesn't shift any file twice.
+    journal_file = plan_file + JOURNAL_EXT
+    done = set()
+    
+    if os.path.exists(journal_file):
+        with open(journal_file, "r", encoding="utf-8") as fr:
+            done = set(line.rstrip("\n") for line in fr)
+    
+    # Failed files aren't journaled, so that they're retried when the plan 
+    # is applied again.
+    failed = 0
+    
+    with open(journal_file, "a", encoding="utf-8") as fw:
+        for sync in syncs:
+            if sync["file"] in done:
+                continue
+            # Plans written before transform chains have a delay and growth.
+            try:
+                transforms = sync.get("transforms") \
+                             or legacy_transforms(sync["delay"], 
+                                                  sync["growth"])
+                transform = compile_transforms(transforms)
+            except KeyError as e:
+                print("Error: Missing {} for '{}'.".format(e, sync["file"]))
+                failed += 1
+                continue
+            except (ValueError, TypeError) as e:
+                print("Error: Invalid transforms for '{}': {}".format(
+                      sync["file"], e))
+                failed += 1
+                continue
+            
+            try:
+                synced = sync_sub(sync["file"], transform)
+            except (OSError, UnicodeError) as e:
+                print("Error: {}".format(e))
+                synced = False
+            
+            if not synced:
+                failed += 1
+                continue
+            
+            fw.write(sync["file"] + "\n")
+            fw.flush()
+            os.fsync(fw.fileno())
+    
+    if failed > 0:
+        print("Failed to synchronise {} files, apply the plan again to "
+              "retry them.".format(failed))
+    
+    return failed == 0
+
+
 def growth_type(x):
     x = float(x)
     if x < 1.0:
@@ -116,36 +315,98 @@ def get_args():
     growth_help = """Delay growth factor, in case subtitles are fit for 
                      different frame rate than video. Default, and minimum, 
                      value is 1.0 (meaning no delay growth)."""
+    trans_help  = """A transform to apply after the delay, e.g. 
+                     'fps=23.976:25' or 'shift=-500'. Can be given several 
+                     times to form a chain, applied in order. See the module 
+                     documentation for the supported transforms."""
+    conf_help   = """A JSON config file with a chain of transforms, as 
+                     {"transforms": ["fps=ntsc-pal", "shift=1200"]}, applied 
+                     after the delay and before any '--transform'."""
+    plan_help   = """Write the synchronisations to a JSON plan file instead of 
+                     performing them, without prompting for confirmation."""
+    apply_help  = """Apply the synchronisations of a plan file written using 
+                     '--plan', without prompting for confirmation. An 
+                     interrupted apply is resumed by applying the plan again. 
+                     All other parameters are ignored."""
     
     parser = argparse.ArgumentParser(prog="subsync", description=prog_desc)
-    parser.add_argument("delay", help=delay_help, type=int)
+    parser.add_argument("delay", help=delay_help, type=int, nargs="?")
     parser.add_argument("-t", "--target", help=tgt_help, default=".")
     parser.add_argument("-g", "--growth", help=growth_help, type=growth_type, 
                         default=1.0)
+    parser.add_argument("-x", "--transform", help=trans_help, 
+                        action="append", default=[])
+    parser.add_argument("-c", "--config", help=conf_help)
+    
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-p", "--plan", help=plan_help)
+    group.add_argument("-a", "--apply", help=apply_help)
+    perfstats.add_arguments(parser)
     
     args = parser.parse_args()
+    perfstats.start("subsync", args.profile, args.profile_dump)
     delay, tgt, growth = args.delay, args.target, args.growth
+    plan_file, apply_file = args.plan, args.apply
+    transforms = []
+    
+    if apply_file is not None:
+        if not os.path.isfile(apply_file):
+            parser.error("'{}' is not a file.".format(apply_file))
+        return transforms, tgt, plan_file, apply_file
+    
+    if delay is not None:
+        transforms += legacy_transforms(delay, growth)
+    
+    if args.config is not None:
+        try:
+            with open(args.config, "r", encoding="utf-8") as fr:
+                transforms += json.load(fr)["transforms"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            parser.error("Invalid config file: {}".format(e))
+    
+    transforms += args.transform
+    
+    if len(transforms) == 0:
+        parser.error("the following arguments are required: delay, or "
+                     "'--transform' or '--config'")
+    
+    try:
+        compile_transforms(transforms)
+    except ValueError as e:
+        parser.error(str(e))
     
     if os.path.isfile(tgt) and os.path.splitext(tgt)[1] not in SUPP_SUB_EXTS:
         parser.error("'{}' is of unsupported subtitle format.".format(tgt))
     
-    return delay, tgt, growth
+    return transforms, tgt, plan_file, apply_file
 
 
 def main():
-    delay, tgt, growth = get_args()
+    transforms, tgt, plan_file, apply_file = get_args()
+    
+    if apply_file is not None:
+        return 0 if apply_plan(apply_file) else 1
+    
     subs = get_sub_files(tgt)
     
     if not subs:
         print("No subtitles to synchronise.")
-        return
+        return 0
     
-    if not confirm_sync(subs, delay, growth):
-        return
+    if plan_file is not None:
+        write_plan(plan_file, subs, transforms)
+        print("Wrote {} synchronisations to plan: {}".format(len(subs), 
+                                                            plan_file))
+        return 0
     
-    for file in subs:
-        sync_sub(file, delay, growth)
+    with perfstats.phase("confirm"):
+        if not confirm_sync(subs, transforms):
+            return 0
+    
+    transform = compile_transforms(transforms)
+    results = [sync_sub(file, transform) for file in subs]
+    return 0 if all(results) else 1
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,545 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+A module for probing the duration, resolution and video codec of video files 
+from their container headers, without any external tools. Matroska (EBML), 
+MP4/M4V (moov box) and AVI (RIFF hdrl list) containers are supported. The 
+files are memory-mapped and only the header elements are read, so probing 
+costs a few page reads regardless of the file size.
+
+The probed metadata is cached in a persistent library index, keyed on the 
+path of each file and validated by its size and modification time, so that 
+the files are only probed again when they change. The video files in a 
+directory tree are listed from a persistent directory index, which is only 
+updated for the directories that changed since they were indexed, so that 
+the files can be selected from the indices without touching them.
+"""
+
+import collections
+import mmap
+import os
+import struct
+
+import perfstats
+
+
+LIBRARY_FN = os.path.join(os.path.expanduser("~"), ".vidsub_library.json")
+"""The file in which the library index is kept, mapping the absolute paths of 
+video files to their size, modification time and :class:`MediaInfo` fields 
+once probed, along with any other recorded fields such as whether they have 
+been played. Load and save it using the :mod:`jsoncache` module."""
+
+DIR_INDEX_FN = os.path.join(os.path.expanduser("~"), ".vidsub_dirs.json")
+"""The file in which the directory index is kept, mapping the absolute paths 
+of directories to their modification time, video files and subdirectories, 
+see :func:`scan_tree`. Load and save it using the :mod:`jsoncache` 
+module."""
+
+VID_EXTS = [".avi", ".mp4", ".mkv", ".m4v"]
+"""The video file formats that are indexed."""
+
+MediaInfo = collections.namedtuple("MediaInfo", 
+                                   ["duration", "width", "height", "codec"])
+"""The metadata of a video file: the duration in seconds, the resolution of 
+the first video track in pixels and its codec. Fields that can't be probed 
+are None."""
+
+NO_INFO = MediaInfo(None, None, None, None)
+
+CODECS = {"V_MPEG4/ISO/AVC": "h264", "V_MPEGH/ISO/HEVC": "hevc", 
+          "V_MPEG4/ISO/ASP": "mpeg4", "V_MPEG4/ISO/SP": "mpeg4", 
+          "V_MPEG2": "mpeg2", "V_VP8": "vp8", "V_VP9": "vp9", "V_AV1": "av1", 
+          "avc1": "h264", "avc3": "h264", "hvc1": "hevc", "hev1": "hevc", 
+          "mp4v": "mpeg4", "vp09": "vp9", "av01": "av1", 
+          "h264": "h264", "x264": "h264", "hevc": "hevc", "h265": "hevc", 
+          "xvid": "mpeg4", "divx": "mpeg4", "dx50": "mpeg4", "fmp4": "mpeg4", 
+          "mp42": "msmpeg4", "mp43": "msmpeg4", "div3": "msmpeg4", 
+          "avc": "h264", "h.264": "h264", "x265": "hevc", "h.265": "hevc"}
+"""The normalised names of the codec identifiers of the containers, and of 
+common codec aliases entered by users."""
+
+EBML_ID = 0x1A45DFA3
+MKV_SEGMENT = 0x18538067
+MKV_SEEK_HEAD = 0x114D9B74
+MKV_SEEK = 0x4DBB
+MKV_SEEK_ID = 0x53AB
+MKV_SEEK_POS = 0x53AC
+MKV_INFO = 0x1549A966
+MKV_TIMECODE_SCALE = 0x2AD7B1
+MKV_DURATION = 0x4489
+MKV_TRACKS = 0x1654AE6B
+MKV_TRACK_ENTRY = 0xAE
+MKV_TRACK_TYPE = 0x83
+MKV_CODEC_ID = 0x86
+MKV_VIDEO = 0xE0
+MKV_PIXEL_WIDTH = 0xB0
+MKV_PIXEL_HEIGHT = 0xBA
+MKV_CLUSTER = 0x1F43B675
+
+MP4_TOP_BOXES = [b"ftyp", b"moov", b"mdat", b"free", b"skip", b"wide"]
+
+
+def norm_codec(codec):
+    """Normalises a codec identifier of a container.
+    
+    :param codec: The codec identifier, or None if unknown.
+    :return: The normalised codec name, or the identifier in lowercase if 
+        it's unknown.
+    :rtype: string
+    """
+    if not codec:
+        return None
+    codec = codec.strip("\0 ")
+    return CODECS.get(codec, CODECS.get(codec.lower(), codec.lower()))
+
+
+def read_vint(mm, pos, keep_marker=False):
+    """Reads an EBML variable-length integer.
+    
+    :param mm: The mapped file.
+    :param pos: The position of the integer.
+    :param keep_marker: Whether to keep the length marker bit, as in 
+        element IDs.
+    :raises ValueError: Raised if the integer is invalid.
+    :return: The integer, None if it's an unknown size, and the position 
+        after it.
+    :rtype: (int, int) tuple
+    """
+    first = mm[pos]
+    length = 9 - first.bit_length()
+    tail = mm[pos+1:pos+length]
+    
+    if first == 0 or len(tail) != length - 1:
+        raise ValueError("Invalid EBML integer.")
+    
+    value = first if keep_marker else first & (0xFF >> length)
+    for b in tail:
+        value = value << 8 | b
+    
+    if not keep_marker and value == (1 << 7 * length) - 1:
+        value = None
+    return value, pos + length
+
+
+def ebml_elements(mm, start, end):
+    """Iterates over the EBML elements in a range of a file, without reading 
+    their data.
+    
+    :param mm: The mapped file.
+    :param start: The start of the range.
+    :param end: The end of the range.
+    :return: The elements, as (ID, data start, data end) tuples. Elements of 
+        unknown size extend to the end of the range.
+    :rtype: generator
+    """
+    pos = start
+    while pos < end:
+        el_id, pos = read_vint(mm, pos, keep_marker=True)
+        size, pos = read_vint(mm, pos)
+        el_end = end if size is None else min(pos + size, end)
+        yield el_id, pos, el_end
+        pos = el_end
+
+
+def ebml_children(mm, start, end):
+    """Gets the first child elements of each ID of an EBML element.
+    
+    :param mm: The mapped file.
+    :param start: The start of the element's data.
+    :param end: The end of the element's data.
+    :return: The data start and end of the children, by ID.
+    :rtype: dict
+    """
+    children = {}
+    for el_id, s, e in ebml_elements(mm, start, end):
+        children.setdefault(el_id, (s, e))
+    return children
+
+
+def ebml_uint(mm, start, end):
+    return int.from_bytes(mm[start:end], "big")
+
+
+def probe_mkv(mm):
+    """Probes a Matroska file. The Info and Tracks elements are found among 
+    the elements preceding the first Cluster, or through the SeekHead if 
+    they're written after the Clusters.
+    
+    :param mm: The mapped file.
+    :return: The metadata of the file.
+    :rtype: :class:`MediaInfo`
+    """
+    for el_id, seg_start, seg_end in ebml_elements(mm, 0, len(mm)):
+        if el_id == MKV_SEGMENT:
+            break
+    else:
+        return NO_INFO
+    
+    found = {}
+    seeks = {}
+    
+    for el_id, start, end in ebml_elements(mm, seg_start, seg_end):
+        if el_id in (MKV_INFO, MKV_TRACKS):
+            found[el_id] = start, end
+        elif el_id == MKV_SEEK_HEAD:
+            for _, s, e in ebml_elements(mm, start, end):
+                seek = ebml_children(mm, s, e)
+                if MKV_SEEK_ID in seek and MKV_SEEK_POS in seek:
+                    seeks[ebml_uint(mm, *seek[MKV_SEEK_ID])] = \
+                        ebml_uint(mm, *seek[MKV_SEEK_POS])
+        if el_id == MKV_CLUSTER or len(found) == 2:
+            break
+    
+    for el_id in (MKV_INFO, MKV_TRACKS):
+        if el_id not in found and el_id in seeks:
+            pos = seg_start + seeks[el_id]
+            for seek_id, start, end in ebml_elements(mm, pos, seg_end):
+                if seek_id == el_id:
+                    found[el_id] = start, end
+                break
+    
+    duration = width = height = codec = None
+    
+    if MKV_INFO in found:
+        scale = 1000000
+        for el_id, start, end in ebml_elements(mm, *found[MKV_INFO]):
+            if el_id == MKV_TIMECODE_SCALE:
+                scale = ebml_uint(mm, start, end)
+            elif el_id == MKV_DURATION and end - start in (4, 8):
+                fmt = ">f" if end - start == 4 else ">d"
+                duration = struct.unpack(fmt, mm[start:end])[0]
+        if duration is not None:
+            duration = duration * scale / 1e9
+    
+    tracks = found.get(MKV_TRACKS, (0, 0))
+    
+    for el_id, start, end in ebml_elements(mm, *tracks):
+        if el_id != MKV_TRACK_ENTRY:
+            continue
+        track = ebml_children(mm, start, end)
+        if ebml_uint(mm, *track.get(MKV_TRACK_TYPE, (0, 0))) != 1:
+            continue
+        if MKV_CODEC_ID in track:
+            start, end = track[MKV_CODEC_ID]
+            codec = bytes(mm[start:end]).decode("ascii", "replace")
+        video = ebml_children(mm, *track.get(MKV_VIDEO, (0, 0)))
+        if MKV_PIXEL_WIDTH in video and MKV_PIXEL_HEIGHT in video:
+            width = ebml_uint(mm, *video[MKV_PIXEL_WIDTH])
+            height = ebml_uint(mm, *video[MKV_PIXEL_HEIGHT])
+        break
+    
+    return MediaInfo(duration, width, height, norm_codec(codec))
+
+
+def mp4_boxes(mm, start, end):
+    """Iterates over the MP4 boxes in a range of a file, without reading 
+    their data.
+    
+    :param mm: The mapped file.
+    :param start: The start of the range.
+    :param end: The end of the range.
+    :raises ValueError: Raised if a box is invalid.
+    :return: The boxes, as (type, data start, data end) tuples.
+    :rtype: generator
+    """
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", mm, pos)
+        hdr_size = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", mm, pos + 8)[0]
+            hdr_size = 16
+        elif size == 0:
+            size = end - pos
+        if size < hdr_size:
+            raise ValueError("Invalid MP4 box.")
+        yield box_type, pos + hdr_size, min(pos + size, end)
+        pos += size
+
+
+def find_box(mm, start, end, path):
+    """Finds the first box on a path of nested box types.
+    
+    :param mm: The mapped file.
+    :param start: The start of the range to look in.
+    :param end: The end of the range to look in.
+    :param path: The box types, from the outermost box.
+    :return: The data start and end of the box, or None if it's not found.
+    :rtype: (int, int) tuple
+    """
+    for box_type in path:
+        for found_type, start, end in mp4_boxes(mm, start, end):
+            if found_type == box_type:
+                break
+        else:
+            return None
+    return start, end
+
+
+def probe_mp4(mm):
+    """Probes an MP4 file. The boxes before the moov box, e.g. the media 
+    data when it's written first, are skipped by their sizes without reading 
+    them.
+    
+    :param mm: The mapped file.
+    :return: The metadata of the file.
+    :rtype: :class:`MediaInfo`
+    """
+    moov = find_box(mm, 0, len(mm), [b"moov"])
+    if moov is None:
+        return NO_INFO
+    
+    duration = width = height = codec = None
+    mvhd = find_box(mm, *moov, [b"mvhd"])
+    
+    if mvhd is not None:
+        if mm[mvhd[0]] == 1:
+            timescale, dur = struct.unpack_from(">IQ", mm, mvhd[0] + 20)
+        else:
+            timescale, dur = struct.unpack_from(">II", mm, mvhd[0] + 12)
+        if timescale > 0:
+            duration = dur / timescale
+    
+    for box_type, start, end in mp4_boxes(mm, *moov):
+        if box_type != b"trak":
+            continue
+        hdlr = find_box(mm, start, end, [b"mdia", b"hdlr"])
+        if hdlr is None or mm[hdlr[0]+8:hdlr[0]+12] != b"vide":
+            continue
+        
+        tkhd = find_box(mm, start, end, [b"tkhd"])
+        if tkhd is not None:
+            offset = 88 if mm[tkhd[0]] == 1 else 76
+            width, height = (x >> 16 for x in struct.unpack_from(
+                ">II", mm, tkhd[0] + offset))
+        
+        stsd = find_box(mm, start, end, 
+                        [b"mdia", b"minf", b"stbl", b"stsd"])
+        if stsd is not None:
+            codec = bytes(mm[stsd[0]+12:stsd[0]+16]).decode("ascii", 
+                                                            "replace")
+            if not width or not height:
+                width, height = struct.unpack_from(">HH", mm, stsd[0] + 40)
+        break
+    
+    return MediaInfo(duration, width, height, norm_codec(codec))
+
+
+def riff_chunks(mm, start, end):
+    """Iterates over the RIFF chunks in a range of a file, without reading 
+    their data.
+    
+    :param mm: The mapped file.
+    :param start: The start of the range.
+    :param end: The end of the range.
+    :return: The chunks, as (ID, data start, data end) tuples. The data of 
+        lists starts with their list type.
+    :rtype: generator
+    """
+    pos = start
+    while pos + 8 <= end:
+        chunk_id, size = struct.unpack_from("<4sI", mm, pos)
+        yield chunk_id, pos + 8, min(pos + 8 + size, end)
+        pos += 8 + size + (size & 1)
+
+
+def find_riff_chunk(mm, start, end, chunk_id, list_type=None):
+    """Finds the first RIFF chunk with an ID, or the first list of a type.
+    
+    :param mm: The mapped file.
+    :param start: The start of the range to look in.
+    :param end: The end of the range to look in.
+    :param chunk_id: The ID of the chunk.
+    :param list_type: The type of the list, if looking for a list.
+    :return: The data start and end of the chunk, with the data of lists 
+        starting after their type, or None if it's not found.
+    :rtype: (int, int) tuple
+    """
+    for found_id, s, e in riff_chunks(mm, start, end):
+        if found_id != chunk_id:
+            continue
+        if list_type is None:
+            return s, e
+        if mm[s:s+4] == list_type:
+            return s + 4, e
+    return None
+
+
+def probe_avi(mm):
+    """Probes an AVI file. The frame count of OpenDML files larger than 
+    1 GiB is read from the extended header, since the main header only 
+    counts the frames of the first RIFF chunk.
+    
+    :param mm: The mapped file.
+    :return: The metadata of the file.
+    :rtype: :class:`MediaInfo`
+    """
+    hdrl = find_riff_chunk(mm, 12, len(mm), b"LIST", b"hdrl")
+    if hdrl is None:
+        return NO_INFO
+    
+    duration = width = height = codec = None
+    frames = us_per_frame = None
+    
+    for chunk_id, start, end in riff_chunks(mm, *hdrl):
+        if chunk_id == b"avih" and end - start >= 40:
+            us_per_frame = struct.unpack_from("<I", mm, start)[0]
+            frames = struct.unpack_from("<I", mm, start + 16)[0]
+            width, height = struct.unpack_from("<II", mm, start + 32)
+        elif chunk_id == b"LIST" and mm[start:start+4] == b"strl" \
+                and codec is None:
+            strh = find_riff_chunk(mm, start + 4, end, b"strh")
+            if strh is None or mm[strh[0]:strh[0]+4] != b"vids":
+                continue
+            codec = bytes(mm[strh[0]+4:strh[0]+8])
+            strf = find_riff_chunk(mm, start + 4, end, b"strf")
+            if strf is not None and strf[1] - strf[0] >= 20 \
+                    and mm[strf[0]+16:strf[0]+20].strip(b"\0"):
+                codec = bytes(mm[strf[0]+16:strf[0]+20])
+            codec = codec.decode("ascii", "replace")
+        elif chunk_id == b"LIST" and mm[start:start+4] == b"odml":
+            dmlh = find_riff_chunk(mm, start + 4, end, b"dmlh")
+            if dmlh is not None and dmlh[1] - dmlh[0] >= 4:
+                frames = struct.unpack_from("<I", mm, dmlh[0])[0]
+    
+    if frames and us_per_frame:
+        duration = frames * us_per_frame / 1e6
+    
+    return MediaInfo(duration, width, height, norm_codec(codec))
+
+
+def probe_file(path):
+    """Probes a video file, detecting its container from its header.
+    
+    :param path: The path of the video file.
+    :return: The metadata of the file, with all fields None if the container 
+        is unsupported or the header is invalid.
+    :rtype: :class:`MediaInfo`
+    """
+    if os.path.getsize(path) == 0:
+        return NO_INFO
+    
+    with perfstats.phase("probe"), open(path, "rb") as fr, \
+            mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        try:
+            if mm[:4] == struct.pack(">I", EBML_ID):
+                return probe_mkv(mm)
+            if mm[:4] == b"RIFF" and mm[8:12] == b"AVI ":
+                return probe_avi(mm)
+            if mm[4:8] in MP4_TOP_BOXES:
+                return probe_mp4(mm)
+        except (ValueError, IndexError, struct.error):
+            pass
+    
+    return NO_INFO
+
+
+def scan_tree(root, dir_index):
+    """Lists the video files in a directory tree using the directory index. 
+    Only the directories whose modification time changed since they were 
+    indexed are listed again, so an unchanged tree costs one stat per 
+    directory and none per file. Directories that no longer exist are 
+    removed from the index.
+    
+    :param root: The root directory of the tree.
+    :param dir_index: The directory index, loaded from :data:`DIR_INDEX_FN`. 
+        It's updated with the listed directories.
+    :return: The absolute paths of the video files in the tree.
+    :rtype: string list
+    """
+    root = os.path.abspath(root)
+    files, seen, stack = [], set(), [root]
+    
+    while stack:
+        dir = stack.pop()
+        seen.add(dir)
+        
+        try:
+            mtime = os.stat(dir).st_mtime_ns
+        except OSError:
+            continue
+        
+        entry = dir_index.get(dir)
+        
+        if entry is None or entry["mtime"] != mtime:
+            entry = {"mtime": mtime, "files": [], "dirs": []}
+            perfstats.count("listdir")
+            try:
+                with os.scandir(dir) as it:
+                    for de in it:
+                        if de.is_dir():
+                            entry["dirs"].append(de.name)
+                        elif os.path.splitext(de.name)[1] in VID_EXTS:
+                            entry["files"].append(de.name)
+            except OSError:
+                pass
+            dir_index[dir] = entry
+        
+        files.extend(os.path.join(dir, fn) for fn in entry["files"])
+        stack.extend(os.path.join(dir, sub) for sub in entry["dirs"])
+    
+    for dir in list(dir_index):
+        if (dir == root or dir.startswith(root + os.sep)) \
+                and dir not in seen:
+            del dir_index[dir]
+    
+    return files
+
+
+def get_entry(path, library):
+    """Gets the library index entry of a video file, without probing it.
+    
+    :param path: The path of the video file.
+    :param library: The library index, loaded from :data:`LIBRARY_FN`.
+    :return: The entry, or None if the file isn't indexed.
+    :rtype: dict
+    """
+    return library.get(os.path.abspath(path))
+
+
+def get_indexed_info(path, library):
+    """Gets the metadata of a video file from the library index, without 
+    touching the file.
+    
+    :param path: The path of the video file.
+    :param library: The library index, loaded from :data:`LIBRARY_FN`.
+    :return: The indexed metadata of the file, which may be outdated if the 
+        file changed, or None if the file hasn't been probed.
+    :rtype: :class:`MediaInfo`
+    """
+    entry = get_entry(path, library)
+    if entry is None or "size" not in entry:
+        return None
+    return MediaInfo(*(entry[field] for field in MediaInfo._fields))
+
+
+def set_played(path, library):
+    """Records in the library index that a video file has been played.
+    
+    :param path: The path of the video file.
+    :param library: The library index, loaded from :data:`LIBRARY_FN`.
+    """
+    library.setdefault(os.path.abspath(path), {})["played"] = True
+
+
+def get_media_info(path, library):
+    """Gets the metadata of a video file from the library index, probing the 
+    file using :func:`probe_file` only if it isn't indexed or has changed 
+    since it was probed.
+    
+    :param path: The path of the video file.
+    :param library: The library index, loaded from :data:`LIBRARY_FN`. It's 
+        updated if the file is probed.
+    :return: The metadata of the file.
+    :rtype: :class:`MediaInfo`
+    """
+    st = os.stat(path)
+    entry = get_entry(path, library) or {}
+    
+    if entry.get("size") != st.st_size or entry.get("mtime") != st.st_mtime_ns:
+        entry.update(probe_file(path)._asdict(), size=st.st_size, 
+                     mtime=st.st_mtime_ns)
+        library[os.path.abspath(path)] = entry
+    
+    return MediaInfo(*(entry[field] for field in MediaInfo._fields))
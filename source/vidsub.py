@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+A module exposing the functionality of the command line tools as a library, 
+for embedding in other programs without starting a new process per file. 
+Unlike the tools, the functions never print or prompt; they return structured 
+results and raise a subclass of :class:`VidSubError` on failure. Like the 
+tools, they do keep the caches of the :mod:`renamer` module up to date: 
+guessing a link writes the guessed page titles to 
+:data:`renamer.LINK_CACHE_FN`, and planning subtitle renames writes the 
+hashes of video files to :data:`renamer.HASH_CACHE_FN`. The I/O-bound 
+functions have `async` variants, which run them in the event loop's default 
+executor, so that many operations can be awaited concurrently.
+"""
+
+import asyncio
+import collections
+import functools
+import os
+
+import delaycalc
+import renamer
+import subsync
+
+
+class VidSubError(Exception):
+    """The base class of all errors raised by this module."""
+
+
+class SubtitleError(VidSubError):
+    """Raised if a subtitle file can't be read or synchronised."""
+
+
+class DelayCalcError(VidSubError):
+    """Raised if the delay of a subtitle file can't be calculated."""
+
+
+class ShowInfoError(VidSubError):
+    """Raised if the link to a show's Wikipedia page can't be guessed, or the 
+    information about the show can't be fetched or scraped from it."""
+
+
+class RenameError(VidSubError):
+    """Raised if a directory can't be read for planning renames, or planned 
+    renames can't be performed without overwriting files or fail."""
+
+
+SyncResult = collections.namedtuple("SyncResult", 
+                                    ["file", "delay", "growth", "transforms", 
+                                     "times"])
+"""The result of synchronising a subtitle file: the file, the delay, growth 
+factor and further transforms it was synchronised with, and the number of 
+times shifted."""
+
+DelayResult = collections.namedtuple("DelayResult", ["delay", "growth"])
+"""The initial delay and delay growth factor of a subtitle file."""
+
+ShowInfo = collections.namedtuple("ShowInfo", 
+                                  ["link", "s_name", "s_num", "e_nums", 
+                                   "e_names"])
+"""The information about a show's season: the link to its Wikipedia page, the 
+show name, the season number, and the numbers and names of its episodes."""
+
+RenamePlan = collections.namedtuple("RenamePlan", 
+                                    ["renames", "unmatched", "positional", 
+                                     "warnings"])
+"""A plan of renames, as a list of dicts in the format of the plan files 
+written by :func:`renamer.write_plan`, along with the list of files that 
+couldn't be paired with a new name and are left out of the plan, and the list 
+of files that were paired with a new name by position rather than by episode 
+number, and the list of warnings, e.g. about an ignored malformed sidecar 
+file. Plans with files paired by position should be reviewed before being 
+applied."""
+
+
+def shift_subs(data, delay, growth=1.0, transforms=None):
+    """Shifts all times in the contents of a subtitle file.
+    
+    :param data: The contents of the subtitle file.
+    :param delay: The time adjustment in milliseconds.
+    :param growth: The delay growth factor.
+    :param transforms: The transforms applied after the delay, in the format 
+        of the `-t/--transform` arguments of :mod:`subsync`, e.g. 
+        ``["fps=pal-ntsc", "clamp=0:"]``.
+    :raises SubtitleError: Raised if the transforms are invalid, or the delay 
+        would make the first time negative.
+    :return: The shifted contents.
+    :rtype: string
+    """
+    steps = subsync.legacy_transforms(delay, growth) + list(transforms or [])
+    
+    try:
+        transform = subsync.compile_transforms(steps)
+        return subsync.transform_data(data, transform)
+    except ValueError as e:
+        raise SubtitleError(str(e) or "Invalid subtitle data.") from e
+
+
+def sync_sub_file(file, delay, growth=1.0, transforms=None):
+    """Synchronises a subtitle file in place, see :func:`shift_subs`.
+    
+    :param file: The path to the subtitle file.
+    :param delay: The time adjustment in milliseconds.
+    :param growth: The delay growth factor.
+    :param transforms: The transforms applied after the delay.
+    :raises SubtitleError: Raised if the file can't be read, written or 
+        synchronised.
+    :return: The result of the synchronisation.
+    :rtype: :class:`SyncResult`
+    """
+    try:
+        data = subsync.read_sub(file)
+    except (OSError, UnicodeError) as e:
+        raise SubtitleError(str(e)) from e
+    
+    synced = shift_subs(data, delay, growth, transforms)
+    
+    try:
+        subsync.write_sub(file, synced)
+    except OSError as e:
+        raise SubtitleError(str(e)) from e
+    
+    times = len(subsync.TIME_PATTERN.findall(data))
+    return SyncResult(file, delay, growth, list(transforms or []), times)
+
+
+def calc_delay(data, time1, time2):
+    """Calculates the initial delay and delay growth factor of the contents 
+    of a subtitle file, see :func:`delaycalc.calc_delay`.
+    
+    :param data: The contents of the subtitle file.
+    :param time1: Time in ms of the first spoken line in the video file.
+    :param time2: Time in ms of the last spoken line in the video file.
+    :raises DelayCalcError: Raised if the subtitle data contains too few 
+        times, or the times yield no valid growth factor.
+    :return: The calculated delay.
+    :rtype: :class:`DelayResult`
+    """
+    try:
+        return DelayResult(*delaycalc.calc_delay(data, time1, time2))
+    except (IndexError, ValueError, ZeroDivisionError) as e:
+        raise DelayCalcError(str(e) or "Invalid subtitle data.") from e
+
+
+def calc_delay_file(file, time1, time2):
+    """Calculates the initial delay and delay growth factor of a subtitle 
+    file, see :func:`calc_delay`.
+    
+    :param file: The path to the subtitle file.
+    :param time1: Time in ms of the first spoken line in the video file.
+    :param time2: Time in ms of the last spoken line in the video file.
+    :raises DelayCalcError: Raised if the file can't be read or its delay 
+        can't be calculated.
+    :return: The calculated delay.
+    :rtype: :class:`DelayResult`
+    """
+    try:
+        with open(file, "r") as fr:
+            data = fr.read()
+    except (OSError, UnicodeError) as e:
+        raise DelayCalcError(str(e)) from e
+    
+    return calc_delay(data, time1, time2)
+
+
+def guess_link(dir=None, s_name=None, s_num=None, sngl=False, snap=None):
+    """Guesses the link to a show's season's Wikipedia page, see 
+    :func:`renamer.guess_link`.
+    
+    :param dir: The directory of video files from which the show name and 
+        season number are matched, if not specified.
+    :param s_name: The show name (optional, matched if not specified).
+    :param s_num: The season number (optional, matched if not specified).
+    :param sngl: Denoting that the show only has one season.
+    :param snap: The :class:`renamer.DirSnapshot` of the directory (optional, 
+        taken of the `dir` parameter if not specified).
+    :raises ShowInfoError: Raised if the link can't be guessed.
+    :return: The guessed link, along with the show name and season number.
+    :rtype: (string, string, int) tuple
+    """
+    try:
+        if snap is None and dir is not None:
+            snap = renamer.DirSnapshot(dir)
+        return renamer.guess_link(snap, s_name, s_num, sngl)
+    except Exception as e:
+        raise ShowInfoError("Failed to guess link to show.") from e
+
+
+def fetch_show_info(link=None, dir=None, s_name=None, s_num=None, 
+                    sngl=False, snap=None):
+    """Fetches the information about a show's season from its Wikipedia 
+    page, guessing the link using :func:`guess_link` if not specified.
+    
+    :param link: The link to the season's Wikipedia page (optional, guessed 
+        if not specified).
+    :param dir: See :func:`guess_link`.
+    :param s_name: The show name (optional, matched or scraped if not 
+        specified).
+    :param s_num: The season number (optional, matched or scraped if not 
+        specified).
+    :param sngl: Denoting that the show only has one season.
+    :param snap: See :func:`guess_link`.
+    :raises ShowInfoError: Raised if the link can't be guessed, or the 
+        information can't be fetched or scraped.
+    :return: The information about the season.
+    :rtype: :class:`ShowInfo`
+    """
+    if link is None:
+        link, s_name, s_num = guess_link(dir, s_name, s_num, sngl, snap)
+    
+    try:
+        info = renamer.get_show_info(link, s_name, s_num, sngl)
+    except Exception as e:
+        raise ShowInfoError("Failed to get show information from link.") \
+            from e
+    
+    return ShowInfo(link, *info)
+
+
+def plan_renames(dir, target="VS", show_info=None, link=None, s_name=None, 
+                 s_num=None, sngl=False, e_idxs=None, snap=None, 
+                 template=renamer.NAME_TEMPLATE):
+    """Plans the renames of the video and subtitle files in a directory, the 
+    same way as the renamer tool, without performing them.
+    
+    :param dir: The directory in which to look for video and subtitle files.
+    :param target: The files to rename, 'V' for video files, 'S' for 
+        subtitle files or 'VS' for both.
+    :param show_info: The information about the season used to rename video 
+        files (optional, fetched using :func:`fetch_show_info` with the 
+        `link`, `s_name`, `s_num` and `sngl` parameters if not specified).
+    :param link: See :func:`fetch_show_info`.
+    :param s_name: See :func:`fetch_show_info`.
+    :param s_num: See :func:`fetch_show_info`.
+    :param sngl: See :func:`fetch_show_info`.
+    :param e_idxs: The indices of the selected episodes (optional, all 
+        episodes are selected if not specified).
+    :param snap: The :class:`renamer.DirSnapshot` of the directory (optional, 
+        taken if not specified). It's updated with the planned renames.
+    :param template: The template of the new video filenames, see 
+        :func:`renamer.compile_template`.
+    :raises ShowInfoError: Raised if renaming video files and the 
+        information about the season can't be fetched, or contains an empty 
+        episode name.
+    :raises RenameError: Raised if the directory can't be read, or the 
+        template is invalid.
+    :return: The planned renames.
+    :rtype: :class:`RenamePlan`
+    """
+    try:
+        renamer.compile_template(template)
+        snap = snap or renamer.DirSnapshot(dir)
+    except (OSError, ValueError) as e:
+        raise RenameError(str(e)) from e
+    
+    plan = RenamePlan([], [], [], [])
+    
+    if "V" in target:
+        if show_info is None:
+            show_info = fetch_show_info(link, dir, s_name, s_num, sngl, snap)
+        
+        try:
+            ep_keys, names = renamer.gen_vid_names(*show_info[1:], 
+                                                   e_idxs=e_idxs, 
+                                                   template=template)
+        except AssertionError as e:
+            raise ShowInfoError("Empty episode name after filename "
+                                "sanitiation.") from e
+        
+        plan_stage(plan, snap, renamer.get_vid_files(snap), ep_keys, names)
+    
+    if "S" in target:
+        try:
+            paired, ep_keys, names = renamer.gen_sub_names(snap, plan.warnings)
+        except OSError as e:
+            raise RenameError(str(e)) from e
+        plan_stage(plan, snap, renamer.get_sub_files(snap), ep_keys, names, 
+                   paired)
+    
+    return plan
+
+
+def plan_stage(plan, snap, files, name_keys, names, paired=None):
+    """Adds the renames of one stage of :func:`plan_renames` to a plan, 
+    pairing files with new names by episode number, or by position if no 
+    file contains episode numbers matching any name, in which case the files 
+    are recorded in the plan's `positional` list, and their renames are 
+    marked as positional.
+    
+    :param plan: The :class:`RenamePlan` to add the renames to.
+    :param snap: The :class:`renamer.DirSnapshot` of the directory. It's 
+        updated with the planned renames, so that later stages see the files 
+        under their new names.
+    :param files: The files to rename.
+    :param name_keys: The list of episode keys of each name.
+    :param names: The list of new names, without file extensions.
+    :param paired: The list of files already paired with new names, see 
+        :func:`renamer.pair_files_by_ep`.
+    """
+    pairs, unmatched = renamer.pair_files_by_ep(files, name_keys, names, 
+                                                paired)
+    positional = len(pairs) == 0
+    
+    if positional:
+        pairs, unmatched = list(zip(files, names)), files[len(names):]
+        plan.positional.extend(os.path.join(snap.dir, fn) \
+                               for fn, _ in pairs)
+    
+    old_names = [on for on, _ in pairs]
+    new_names = renamer.assign_exts([nn for _, nn in pairs], 
+                                    renamer.get_file_exts(old_names))
+    
+    renamer.add_to_plan(plan.renames, snap, old_names, new_names, 
+                        positional)
+    plan.unmatched.extend(os.path.join(snap.dir, fn) for fn in unmatched)
+    snap.renamed(old_names, new_names)
+
+
+def apply_renames(renames, journal_fn):
+    """Performs planned renames, journaled so that they can be resumed if 
+    interrupted and undone using :func:`undo_renames`, see 
+    :func:`renamer.journaled_rename`.
+    
+    :param renames: The list of planned renames, e.g. the `renames` of a 
+        :class:`RenamePlan`.
+    :param journal_fn: The filename of the journal. If it exists, the 
+        renames recorded in it are resumed instead.
+    :raises RenameError: Raised if the renames can't be performed without 
+        overwriting files, or a rename fails.
+    """
+    try:
+        if not os.path.exists(journal_fn):
+            renamer.check_renames(renamer.plan_paths(renames))
+        renamer.journaled_rename(renamer.plan_paths(renames), journal_fn)
+    except (OSError, ValueError) as e:
+        raise RenameError(str(e)) from e
+
+
+def undo_renames(journal_fn):
+    """Undoes the renames recorded in a journal, see 
+    :func:`renamer.undo_journal`.
+    
+    :param journal_fn: The filename of the journal.
+    :raises RenameError: Raised if the renames can't be undone without 
+        overwriting files, or an undo fails.
+    """
+    try:
+        renamer.undo_journal(journal_fn)
+    except (OSError, ValueError) as e:
+        raise RenameError(str(e)) from e
+
+
+async def run_async(func, *args, **kwargs):
+    """Runs a blocking function in the event loop's default executor.
+    
+    :param func: The function to run.
+    :return: The return value of the function.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, 
+                                      functools.partial(func, *args, **kwargs))
+
+
+async def sync_sub_file_async(file, delay, growth=1.0, transforms=None):
+    """The `async` variant of :func:`sync_sub_file`."""
+    return await run_async(sync_sub_file, file, delay, growth, transforms)
+
+
+async def calc_delay_file_async(file, time1, time2):
+    """The `async` variant of :func:`calc_delay_file`."""
+    return await run_async(calc_delay_file, file, time1, time2)
+
+
+async def fetch_show_info_async(link=None, dir=None, s_name=None, s_num=None, 
+                                sngl=False, snap=None):
+    """The `async` variant of :func:`fetch_show_info`."""
+    return await run_async(fetch_show_info, link, dir, s_name, s_num, sngl, 
+                           snap)
+
+
+async def plan_renames_async(dir, target="VS", show_info=None, link=None, 
+                             s_name=None, s_num=None, sngl=False, 
+                             e_idxs=None, snap=None, 
+                             template=renamer.NAME_TEMPLATE):
+    """The `async` variant of :func:`plan_renames`."""
+    return await run_async(plan_renames, dir, target, show_info, link, 
+                           s_name, s_num, sngl, e_idxs, snap, template)
+
+
+async def apply_renames_async(renames, journal_fn):
+    """The `async` variant of :func:`apply_renames`."""
+    return await run_async(apply_renames, renames, journal_fn)
@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+A module for running the tools as a long-running local service, so that jobs 
+don't pay for starting a new process, importing modules and refetching show 
+pages. The service listens for HTTP requests on localhost and processes the 
+submitted jobs from a queue using a pool of worker threads, keeping the HTTP 
+session, fetched show information and directory snapshots warm between jobs.
+
+Jobs are submitted as JSON to ``POST /jobs``, e.g. 
+``{"type": "sync", "args": {"file": "ep1.srt", "delay": 500}}``, and the job 
+is returned with its ID. If ``"wait": true`` is included, the response is 
+sent once the job has finished. Jobs are polled with ``GET /jobs/<id>``, and 
+the state of the service with ``GET /status``. The job types and their 
+arguments are those of the functions in :data:`Service.JOB_TYPES`; e.g. 
+`sync` jobs also take the ``"transforms"`` of :func:`vidsub.shift_subs`, such 
+as ``["fps=pal-ntsc"]``.
+
+Every request must carry the token printed when the service starts, in an 
+``Authorization: Bearer <token>`` header, and jobs must be submitted with the 
+``application/json`` content type. Web pages can't send either without the 
+service allowing them to, so they can't submit jobs to it.
+"""
+
+import argparse
+import collections
+import hmac
+import http.server
+import inspect
+import json
+import os
+import queue
+import secrets
+import tempfile
+import threading
+import time
+import uuid
+
+import perfstats
+import renamer
+import subsync
+import vidsub
+
+
+MAX_FINISHED_JOBS = 1000
+"""The maximum number of finished jobs kept for polling."""
+
+SHOW_INFO_TTL = 3600
+"""The time in seconds that fetched show information is cached."""
+
+
+def to_json(obj):
+    """Converts a job result to a JSON serialisable object.
+    
+    :param obj: The result, possibly containing namedtuples.
+    :return: The JSON serialisable object.
+    """
+    if hasattr(obj, "_asdict"):
+        return {k: to_json(v) for k, v in obj._asdict().items()}
+    if isinstance(obj, dict):
+        return {k: to_json(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_json(v) for v in obj]
+    return obj
+
+
+class Service:
+    """The job queue, worker pool and warm caches of the service.
+    
+    :param workers: The number of worker threads.
+    """
+    
+    JOB_TYPES = ["sync", "delay", "show_info", "plan", "apply", "rename"]
+    """The supported job types, each processed by the method of the same 
+    name."""
+    
+    def __init__(self, workers):
+        self.queue = queue.Queue()
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.cache_lock = threading.Lock()
+        self.snaps = {}
+        self.show_infos = {}
+        
+        for _ in range(workers):
+            threading.Thread(target=self.work, daemon=True).start()
+        
+        self.workers = workers
+    
+    def submit(self, job_type, args):
+        """Submits a job to the queue.
+        
+        :param job_type: The type of the job, one of :data:`JOB_TYPES`.
+        :param args: The keyword arguments of the job.
+        :raises ValueError: Raised if the job type is unsupported, or the 
+            arguments don't match those of the job type.
+        :return: The submitted job.
+        :rtype: dict
+        """
+        if job_type not in self.JOB_TYPES:
+            raise ValueError("Unsupported job type '{}'.".format(job_type))
+        if not isinstance(args, dict):
+            raise ValueError("Job arguments must be an object.")
+        
+        try:
+            inspect.signature(getattr(self, job_type)).bind(**args)
+        except TypeError as e:
+            raise ValueError("Invalid arguments: {}".format(e)) from e
+        
+        if job_type == "apply":
+            self.check_renames_arg(args["renames"])
+        if job_type == "sync":
+            self.check_transforms_arg(args.get("transforms"))
+        
+        job = {"id": uuid.uuid4().hex, "type": job_type, "args": args, 
+               "status": "queued", "result": None, "error": None, 
+               "done": threading.Event()}
+        
+        with self.lock:
+            self.jobs[job["id"]] = job
+        
+        self.queue.put(job)
+        return job
+    
+    def check_renames_arg(self, renames):
+        """Checks the planned renames of an `apply` job.
+        
+        :param renames: The planned renames, see 
+            :func:`vidsub.apply_renames`.
+        :raises ValueError: Raised if the renames aren't a list of planned 
+            renames.
+        """
+        keys = ["dir", "old", "new"]
+        
+        if not isinstance(renames, list) or not all( \
+                isinstance(r, dict) \
+                and all(isinstance(r.get(k), str) for k in keys) \
+                for r in renames):
+            raise ValueError("Renames must be a list of objects with string "
+                             "'dir', 'old' and 'new' members.")
+    
+    def check_transforms_arg(self, transforms):
+        """Checks the transforms of a `sync` job.
+        
+        :param transforms: The transforms, see :func:`vidsub.shift_subs`.
+        :raises ValueError: Raised if the transforms aren't a list of valid 
+            transforms.
+        """
+        if transforms is None:
+            return
+        
+        if not isinstance(transforms, list) \
+                or not all(isinstance(t, str) for t in transforms):
+            raise ValueError("Transforms must be a list of strings.")
+        
+        subsync.compile_transforms(transforms)
+    
+    def get_job(self, job_id):
+        """Gets a submitted job.
+        
+        :param job_id: The ID of the job.
+        :return: The job, or None if there's no such job.
+        :rtype: dict
+        """
+        with self.lock:
+            return self.jobs.get(job_id)
+    
+    def work(self):
+        """Processes jobs from the queue, forever."""
+        while True:
+            job = self.queue.get()
+            job["status"] = "running"
+            
+            try:
+                with perfstats.phase("job_" + job["type"]):
+                    result = getattr(self, job["type"])(**job["args"])
+                job["result"] = to_json(result)
+                job["status"] = "done"
+            except Exception as e:
+                job["error"] = "{}: {}".format(type(e).__name__, e)
+                job["status"] = "failed"
+            finally:
+                if job["status"] == "running":
+                    job["status"] = "failed"
+                job["done"].set()
+                self.prune()
+    
+    def prune(self):
+        """Forgets the oldest finished jobs beyond 
+        :data:`MAX_FINISHED_JOBS`."""
+        with self.lock:
+            finished = [job_id for job_id, job in self.jobs.items() \
+                        if job["done"].is_set()]
+            for job_id in finished[:-MAX_FINISHED_JOBS]:
+                del self.jobs[job_id]
+    
+    def get_snap(self, dir):
+        """Gets a copy of the cached snapshot of a directory, taking a new 
+        snapshot if the directory has changed since it was cached, based on 
+        its modification time.
+        
+        :param dir: The directory.
+        :return: The snapshot, which may be modified freely.
+        :rtype: :class:`renamer.DirSnapshot`
+        """
+        dir = os.path.abspath(dir)
+        mtime = os.stat(dir).st_mtime_ns
+        
+        with self.cache_lock:
+            cached = self.snaps.get(dir)
+        
+        if cached is None or cached[0] != mtime:
+            cached = mtime, renamer.DirSnapshot(dir)
+            with self.cache_lock:
+                self.snaps[dir] = cached
+        
+        return cached[1].copy()
+    
+    def get_show_info(self, link=None, dir=None, s_name=None, s_num=None, 
+                      sngl=False):
+        """Gets the information about a show's season, from the cache if it 
+        was fetched within :data:`SHOW_INFO_TTL` seconds, see 
+        :func:`vidsub.fetch_show_info`.
+        
+        :return: The information about the season.
+        :rtype: :class:`vidsub.ShowInfo`
+        """
+        if link is None:
+            snap = self.get_snap(dir) if dir is not None else None
+            link, s_name, s_num = vidsub.guess_link(dir, s_name, s_num, sngl, 
+                                                    snap)
+        
+        key = (link, s_name, s_num, sngl)
+        with self.cache_lock:
+            cached = self.show_infos.get(key)
+        
+        if cached is None or time.time() - cached[0] > SHOW_INFO_TTL:
+            cached = time.time(), vidsub.fetch_show_info(link, None, s_name, 
+                                                         s_num, sngl)
+            with self.cache_lock:
+                self.show_infos[key] = cached
+        
+        return cached[1]
+    
+    def sync(self, file, delay=0, growth=1.0, transforms=None):
+        """Synchronises a subtitle file, see :func:`vidsub.sync_sub_file`."""
+        return vidsub.sync_sub_file(file, delay, growth, transforms)
+    
+    def delay(self, file, time1, time2):
+        """Calculates the delay of a subtitle file, see 
+        :func:`vidsub.calc_delay_file`."""
+        return vidsub.calc_delay_file(file, time1, time2)
+    
+    def show_info(self, link=None, dir=None, s_name=None, s_num=None, 
+                  sngl=False):
+        """Gets the information about a show's season, see 
+        :meth:`get_show_info`."""
+        return self.get_show_info(link, dir, s_name, s_num, sngl)
+    
+    def plan(self, dir, target="VS", link=None, s_name=None, s_num=None, 
+             sngl=False, e_idxs=None, template=renamer.NAME_TEMPLATE):
+        """Plans the renames of the files in a directory, see 
+        :func:`vidsub.plan_renames`."""
+        show_info = None
+        if "V" in target:
+            show_info = self.get_show_info(link, dir, s_name, s_num, sngl)
+        
+        return vidsub.plan_renames(dir, target, show_info, e_idxs=e_idxs, 
+                                   snap=self.get_snap(dir), 
+                                   template=template)
+    
+    def apply(self, renames):
+        """Performs planned renames, see :func:`vidsub.apply_renames`. The 
+        journal is written to the temporary directory, under a name chosen by 
+        the service rather than the client.
+        
+        :return: The filename of the journal, for undoing the renames.
+        :rtype: dict
+        """
+        journal_fn = "vidsubd-{}.journal".format(uuid.uuid4().hex)
+        journal = os.path.join(tempfile.gettempdir(), journal_fn)
+        
+        vidsub.apply_renames(renames, journal)
+        return {"journal": journal}
+    
+    def rename(self, dir, target="VS", link=None, s_name=None, s_num=None, 
+               sngl=False, e_idxs=None, template=renamer.NAME_TEMPLATE):
+        """Plans and performs the renames of the files in a directory, see 
+        :meth:`plan` and :meth:`apply`. Plans with files paired by position 
+        aren't performed, they must be reviewed and submitted to 
+        :meth:`apply` instead.
+        
+        :raises vidsub.RenameError: Raised if files were paired by position.
+        :return: The performed plan and the filename of the journal.
+        :rtype: dict
+        """
+        plan = self.plan(dir, target, link, s_name, s_num, sngl, e_idxs, 
+                         template)
+        if plan.positional:
+            raise vidsub.RenameError("Files were paired with names by "
+                                     "position, review the plan and apply "
+                                     "it instead.")
+        result = self.apply(plan.renames)
+        return {"plan": plan, "journal": result["journal"]}
+    
+    def status(self):
+        """Gets the state of the service.
+        
+        :return: The number of queued and kept jobs, worker threads and 
+            cached directories and show pages.
+        :rtype: dict
+        """
+        return {"queued": self.queue.qsize(), "jobs": len(self.jobs), 
+                "workers": self.workers, "cached_dirs": len(self.snaps), 
+                "cached_shows": len(self.show_infos)}
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handles the HTTP requests to the service, see the module 
+    documentation."""
+    
+    def send_json(self, code, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_job(self, code, job):
+        self.send_json(code, {k: v for k, v in job.items() if k != "done"})
+    
+    def authorised(self):
+        """Checks the token of the request, sending an error if it's missing 
+        or wrong.
+        
+        :return: Whether the request carries the service's token.
+        :rtype: bool
+        """
+        auth = self.headers.get("Authorization", "")
+        expected = "Bearer " + self.server.token
+        
+        if hmac.compare_digest(auth.encode("utf-8"), expected.encode("utf-8")):
+            return True
+        
+        self.send_json(401, {"error": "Missing or invalid token."})
+        return False
+    
+    def do_GET(self):
+        if not self.authorised():
+            return
+        
+        service = self.server.service
+        
+        if self.path == "/status":
+            return self.send_json(200, service.status())
+        
+        if self.path.startswith("/jobs/"):
+            job = service.get_job(self.path[len("/jobs/"):])
+            if job is not None:
+                return self.send_job(200, job)
+        
+        self.send_json(404, {"error": "Not found."})
+    
+    def do_POST(self):
+        if not self.authorised():
+            return
+        if self.path != "/jobs":
+            return self.send_json(404, {"error": "Not found."})
+        
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.split(";")[0].strip().lower() != "application/json":
+            return self.send_json(415, {"error": "Expected application/json."})
+        
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            req = json.loads(self.rfile.read(length).decode("utf-8"))
+            job = self.server.service.submit(req["type"], req.get("args", {}))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return self.send_json(400, {"error": str(e)})
+        
+        if req.get("wait"):
+            job["done"].wait()
+            return self.send_job(200, job)
+        
+        self.send_job(202, job)
+    
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def warm_up():
+    """Imports the network and HTML parsing stacks, which are otherwise 
+    imported lazily by the first job that needs them."""
+    renamer.get_session()
+    import bs4
+
+
+def port_type(port):
+    x = int(port)
+    if not 0 <= x <= 65535:
+        raise argparse.ArgumentTypeError("Port must be within 0-65535.")
+    return x
+
+
+def get_args():
+    prog_desc = """Run the tools as a local service, processing jobs 
+                   submitted over HTTP."""
+    host_help = """The host to listen on. Default is 127.0.0.1, only 
+                   accepting local connections."""
+    port_help = """The port to listen on. Default is 8765."""
+    work_help = """The number of worker threads processing jobs. Default 
+                   is 4."""
+    verb_help = """Log every request."""
+    tokn_help = """The token that requests must carry. Default is a random 
+                   token, printed when the service starts."""
+    
+    parser = argparse.ArgumentParser(prog="vidsubd", description=prog_desc)
+    parser.add_argument("-H", "--host", help=host_help, default="127.0.0.1")
+    parser.add_argument("-p", "--port", help=port_help, type=port_type, 
+                        default=8765)
+    parser.add_argument("-w", "--workers", help=work_help, type=int, 
+                        default=4)
+    parser.add_argument("-v", "--verbose", help=verb_help, 
+                        action="store_true")
+    parser.add_argument("-t", "--token", help=tokn_help)
+    perfstats.add_arguments(parser)
+    
+    args = parser.parse_args()
+    perfstats.start("vidsubd", args.profile, args.profile_dump)
+    
+    if args.workers < 1:
+        parser.error("At least one worker is required.")
+    
+    token = args.token or secrets.token_urlsafe(32)
+    return args.host, args.port, args.workers, args.verbose, token
+
+
+def main():
+    host, port, workers, verbose, token = get_args()
+    warm_up()
+    
+    server = http.server.ThreadingHTTPServer((host, port), RequestHandler)
+    server.service = Service(workers)
+    server.verbose = verbose
+    server.token = token
+    
+    print("Listening on http://{}:{}".format(*server.server_address[:2]))
+    print("Token: {}".format(token))
+    
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+A module for watching a directory tree for new video and subtitle files, 
+e.g. as downloads finish, and processing only the new arrivals: subtitle files 
+are renamed after the video files they're paired with, the same way as the 
+renamer tool does, and synchronised with a configured delay, the same way as 
+the subsync tool does.
+
+An index of the files in the tree, by size and modification time, is built 
+once at startup, after which only the changes reported by the watcher are 
+examined, so the work per change scales with the new files rather than with 
+the size of the tree. Changes are reported by inotify on Linux, and otherwise 
+by polling the modification times of the watched directories. A new or 
+changed file is processed once its size and modification time have stayed 
+the same for the debounce time, so that partially written files are left 
+alone.
+"""
+
+import argparse
+import ctypes
+import os
+import select
+import struct
+import sys
+import time
+
+import perfstats
+import renamer
+import subsync
+
+
+DEBOUNCE = 2.0
+"""The default time in seconds that a file has to stay unchanged before it's 
+processed."""
+
+POLL_INTERVAL = 2.0
+"""The default time in seconds between polls of the watched directories."""
+
+WATCH_EXTS = renamer.SUPP_VID_EXTS + renamer.SUPP_SUB_EXTS
+"""The file extensions of the files that are watched."""
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO \
+          | IN_CREATE | IN_DELETE
+IN_EVENT = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """Reports changes in the watched directories using inotify."""
+    
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.wds = {}
+    
+    @property
+    def dirs(self):
+        return self.wds.values()
+    
+    def add_dir(self, dir):
+        """Starts watching a directory.
+        
+        :param dir: The directory.
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir), IN_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), dir)
+        self.wds[wd] = dir
+    
+    def read(self, timeout):
+        """Waits for changes in the watched directories.
+        
+        :param timeout: The maximum time in seconds to wait, or None to wait 
+            indefinitely.
+        :return: The paths of the changed files and directories. Directories 
+            are listed to find their changed files.
+        :rtype: string list
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        
+        data = os.read(self.fd, 64 * 1024)
+        paths = []
+        pos = 0
+        
+        while pos < len(data):
+            wd, mask, _, length = IN_EVENT.unpack_from(data, pos)
+            name = data[pos+IN_EVENT.size:pos+IN_EVENT.size+length]
+            pos += IN_EVENT.size + length
+            
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so every watched directory is relisted.
+                paths.extend(self.dirs)
+            elif mask & IN_IGNORED:
+                self.wds.pop(wd, None)
+            elif wd in self.wds:
+                name = os.fsdecode(name.rstrip(b"\0"))
+                paths.append(os.path.join(self.wds[wd], name))
+        
+        return paths
+
+
+class PollWatcher:
+    """Reports changes in the watched directories by polling their 
+    modification times. Files that are modified in place don't change the 
+    modification time of their directory, so they're only noticed while 
+    they're still pending.
+    
+    :param interval: The time in seconds between polls.
+    """
+    
+    def __init__(self, interval):
+        self.interval = interval
+        self.mtimes = {}
+    
+    @property
+    def dirs(self):
+        return self.mtimes.keys()
+    
+    def add_dir(self, dir):
+        """Starts watching a directory.
+        
+        :param dir: The directory.
+        """
+        self.mtimes[dir] = os.stat(dir).st_mtime_ns
+    
+    def read(self, timeout):
+        """Waits for the next poll, and checks the watched directories for 
+        changes.
+        
+        :param timeout: The maximum time in seconds to wait, or None to wait 
+            for the next poll.
+        :return: The changed directories.
+        :rtype: string list
+        """
+        time.sleep(self.interval if timeout is None \
+                   else min(timeout, self.interval))
+        changed = []
+        
+        for dir, mtime in list(self.mtimes.items()):
+            try:
+                new_mtime = os.stat(dir).st_mtime_ns
+            except OSError:
+                del self.mtimes[dir]
+                continue
+            
+            if new_mtime != mtime:
+                self.mtimes[dir] = new_mtime
+                changed.append(dir)
+        
+        return changed
+
+
+def make_watcher(poll=False, interval=POLL_INTERVAL):
+    """Creates an inotify watcher if available, and a polling watcher 
+    otherwise.
+    
+    :param poll: Whether to always use a polling watcher.
+    :param interval: The time in seconds between polls.
+    :return: The watcher.
+    :rtype: :class:`InotifyWatcher` or :class:`PollWatcher`
+    """
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError):
+            pass
+    return PollWatcher(interval)
+
+
+def stat_key(path):
+    """Gets the size and modification time of a file, used to tell whether 
+    it has changed.
+    
+    :param path: The path of the file.
+    :return: The size and modification time, or None if the file doesn't 
+        exist.
+    :rtype: (int, int) tuple
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class Watch:
+    """Watches a directory tree and processes new and changed files.
+    
+    :param root: The root directory of the tree.
+    :param watcher: The watcher reporting changes, see :func:`make_watcher`.
+    :param rename: Whether to rename subtitle files after video files.
+    :param delay: The delay to synchronise subtitle files with, or None to 
+        not synchronise them.
+    :param growth: The delay growth factor to synchronise subtitle files 
+        with.
+    :param debounce: The time in seconds that a file has to stay unchanged 
+        before it's processed.
+    """
+    
+    def __init__(self, root, watcher, rename=True, delay=None, growth=1.0, 
+                 debounce=DEBOUNCE):
+        self.root = os.path.abspath(root)
+        self.watcher = watcher
+        self.rename = rename
+        self.transform = None
+        self.debounce = debounce
+        self.index = {}
+        self.pending = {}
+        
+        if delay is not None:
+            self.transform = subsync.compile_transforms(
+                subsync.legacy_transforms(delay, growth))
+        
+        with perfstats.phase("index"):
+            self.scan_dir(self.root, initial=True)
+    
+    def scan_dir(self, dir, initial=False):
+        """Lists a directory, and its new subdirectories recursively, 
+        comparing the files to the index. The directories are watched if they 
+        aren't already.
+        
+        :param dir: The directory.
+        :param initial: Whether to index the files as they are instead of 
+            marking the new and changed ones as pending.
+        """
+        if dir not in self.index:
+            self.watcher.add_dir(dir)
+        
+        files = self.index.setdefault(dir, {})
+        present = set()
+        
+        try:
+            entries = os.scandir(dir)
+        except OSError:
+            # The directory was removed before it could be listed.
+            return
+        
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.path not in self.index:
+                        self.scan_dir(entry.path, initial)
+                elif os.path.splitext(entry.name)[1] in WATCH_EXTS:
+                    present.add(entry.name)
+                    if initial:
+                        files[entry.name] = stat_key(entry.path)
+                    else:
+                        self.check(entry.path)
+        
+        for fn in set(files) - present:
+            del files[fn]
+    
+    def check(self, path):
+        """Marks a file as pending if it's new or has changed since it was 
+        indexed, and forgets it if it no longer exists.
+        
+        :param path: The path of the file.
+        """
+        dir, fn = os.path.split(path)
+        key = stat_key(path)
+        
+        if key is None:
+            self.index.get(dir, {}).pop(fn, None)
+            self.pending.pop(path, None)
+        elif self.index.get(dir, {}).get(fn) != key:
+            if self.pending.get(path, (None,))[0] != key:
+                self.pending[path] = key, time.monotonic()
+    
+    def mark(self, path):
+        """Indexes a file as it is, e.g. after it's been processed, so that 
+        the change isn't processed again.
+        
+        :param path: The path of the file.
+        """
+        dir, fn = os.path.split(path)
+        self.index.setdefault(dir, {})[fn] = stat_key(path)
+        self.pending.pop(path, None)
+    
+    def unmark(self, path):
+        """Removes a file from the index, e.g. after it's been renamed.
+        
+        :param path: The path of the file.
+        """
+        dir, fn = os.path.split(path)
+        self.index.get(dir, {}).pop(fn, None)
+        self.pending.pop(path, None)
+    
+    def handle(self, paths):
+        """Examines the changes reported by the watcher.
+        
+        :param paths: The paths of the changed files and directories.
+        """
+        perfstats.count("events", len(paths))
+        
+        for path in paths:
+            if os.path.isdir(path):
+                self.scan_dir(path)
+            elif os.path.splitext(path)[1] in WATCH_EXTS:
+                self.check(path)
+            elif path in self.index:
+                # A watched directory that no longer exists.
+                del self.index[path]
+    
+    def settle(self):
+        """Gets the pending files that have stayed unchanged for the 
+        debounce time, and indexes them.
+        
+        :return: The settled files, grouped by directory.
+        :rtype: dict
+        """
+        now = time.monotonic()
+        settled = {}
+        
+        for path, (key, since) in list(self.pending.items()):
+            if now - since < self.debounce:
+                continue
+            
+            new_key = stat_key(path)
+            
+            if new_key is None:
+                self.unmark(path)
+            elif new_key != key:
+                self.pending[path] = new_key, now
+            else:
+                self.mark(path)
+                dir, fn = os.path.split(path)
+                settled.setdefault(dir, []).append(fn)
+        
+        return settled
+    
+    def process(self, dir, files):
+        """Processes the settled files of a directory, renaming and 
+        synchronising the new subtitle files. A file that can't be 
+        synchronised, e.g. since it was removed after settling, is reported 
+        and skipped.
+        
+        :param dir: The directory.
+        :param files: The settled files.
+        """
+        print("\n--- NEW FILES IN '{}' ---".format(dir))
+        for fn in files:
+            print(fn)
+        
+        subs = [fn for fn in files \
+                if os.path.splitext(fn)[1] in renamer.SUPP_SUB_EXTS]
+        
+        if self.rename:
+            with perfstats.phase("rename"):
+                new_names = self.rename_subs(dir, files)
+            subs = [new_names.get(fn, fn) for fn in subs]
+        
+        if self.transform is not None:
+            for fn in subs:
+                if os.path.splitext(fn)[1] in subsync.SUPP_SUB_EXTS:
+                    path = os.path.join(dir, fn)
+                    try:
+                        subsync.sync_sub(path, self.transform)
+                    except (OSError, UnicodeError) as e:
+                        print("Error: {}".format(e))
+                    self.mark(path)
+    
+    def rename_subs(self, dir, files):
+        """Renames the subtitle files in a directory that are new, or that 
+        are paired with new video files, after the video files, see 
+        :func:`renamer.rename_sub_files`. Unlike the renamer tool, subtitle 
+        files are only renamed if they can be paired by hash or episode 
+        number, never by position, since not all files of a season may have 
+        arrived yet. The renames are performed using 
+        :func:`renamer.temp_journaled_rename`.
+        
+        :param dir: The directory.
+        :param files: The settled files.
+        :return: The new names of the renamed subtitle files.
+        :rtype: dict
+        """
+        snap = renamer.DirSnapshot(dir)
+        paired, ep_keys, names = renamer.gen_sub_names(snap)
+        pairs, _ = renamer.pair_files_by_ep(renamer.get_sub_files(snap), 
+                                            ep_keys, names, paired)
+        
+        new_files = set(files)
+        new_vid_roots = set(snap.basenames[fn] for fn in files \
+                            if fn in snap.basenames)
+        pairs = [(on, nn) for on, nn in pairs \
+                 if on in new_files \
+                 or renamer.split_lang(nn)[0] in new_vid_roots]
+        
+        old_names = [on for on, _ in pairs]
+        new_names = renamer.assign_exts([nn for _, nn in pairs], 
+                                        renamer.get_file_exts(old_names))
+        plan = []
+        renamer.add_to_plan(plan, snap, old_names, new_names)
+        
+        if len(plan) == 0:
+            return {}
+        
+        renames = renamer.plan_paths(plan)
+        
+        try:
+            renamer.check_renames(renames)
+        except ValueError as e:
+            print("Error: {}".format(e))
+            return {}
+        
+        renamer.temp_journaled_rename(renames, "vidwatch")
+        
+        for on, nn in renames:
+            print("{} --> {}".format(on, nn))
+            self.unmark(on)
+            self.mark(nn)
+        
+        return {r["old"]: r["new"] for r in plan}
+    
+    def run(self):
+        """Watches the tree and processes the settled files, forever. A 
+        directory whose files can't be processed, e.g. since it was removed, 
+        is reported and skipped."""
+        while True:
+            timeout = self.debounce if self.pending else None
+            self.handle(self.watcher.read(timeout))
+            
+            for dir, files in self.settle().items():
+                try:
+                    with perfstats.phase("process"):
+                        self.process(dir, files)
+                except OSError as e:
+                    print("Error: Failed to process '{}': {}".format(dir, e))
+
+
+def get_args():
+    prog_desc  = """Watch a directory tree for new video and subtitle files, 
+                    renaming the new subtitle files after the video files and 
+                    synchronising them."""
+    dir_help   = """The root directory of the tree to watch. Default is the 
+                    current working directory."""
+    ren_help   = """Rename new subtitle files after the video files they're 
+                    paired with by hash or episode number."""
+    sync_help  = """Synchronise new subtitle files with the given delay in 
+                    milliseconds. Positive for delay and negative for 
+                    speed-up."""
+    grow_help  = """Delay growth factor to synchronise new subtitle files 
+                    with. Default, and minimum, value is 1.0."""
+    deb_help   = """The time in seconds that a new file has to stay unchanged 
+                    before it's processed. Default is 2."""
+    poll_help  = """Poll the directories for changes instead of using 
+                    inotify, e.g. on network mounts."""
+    intv_help  = """The time in seconds between polls. Default is 2."""
+    
+    parser = argparse.ArgumentParser(prog="vidwatch", description=prog_desc)
+    parser.add_argument("-d", "--dir", default=".", help=dir_help)
+    parser.add_argument("-r", "--rename", help=ren_help, action="store_true")
+    parser.add_argument("-s", "--sync", help=sync_help, type=int)
+    parser.add_argument("-g", "--growth", help=grow_help, 
+                        type=subsync.growth_type, default=1.0)
+    parser.add_argument("-b", "--debounce", help=deb_help, type=float, 
+                        default=DEBOUNCE)
+    parser.add_argument("--poll", help=poll_help, action="store_true")
+    parser.add_argument("-i", "--interval", help=intv_help, type=float, 
+                        default=POLL_INTERVAL)
+    perfstats.add_arguments(parser)
+    
+    args = parser.parse_args()
+    perfstats.start("vidwatch", args.profile, args.profile_dump)
+    
+    if not os.path.isdir(args.dir):
+        parser.error("'{}' is not a valid directory.".format(args.dir))
+    
+    if not args.rename and args.sync is None:
+        parser.error("Nothing to do. Provide '--rename', '--sync' or both.")
+    
+    return (args.dir, args.rename, args.sync, args.growth, args.debounce, 
+            args.poll, args.interval)
+
+
+def main():
+    dir, rename, delay, growth, debounce, poll, interval = get_args()
+    
+    watcher = make_watcher(poll, interval)
+    watch = Watch(dir, watcher, rename, delay, growth, debounce)
+    
+    print("Watching {} directories under '{}' using {}.".format(
+          len(watch.index), watch.root, 
+          "inotify" if isinstance(watcher, InotifyWatcher) else "polling"))
+    
+    try:
+        watch.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()